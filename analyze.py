@@ -27,46 +27,263 @@ Naming:
 
 """
 import random
-from itertools import izip
+from itertools import product
 from PIL import Image, ImageChops
 import numpy as np
-from scipy.ndimage.measurements import center_of_mass
-from utils import Substitute, log, xyzrange, xyzvrange, find_components
+from scipy.ndimage import label, find_objects, generate_binary_structure
+from scipy.ndimage import correlate1d, maximum_filter, minimum_filter
+from scipy.ndimage import distance_transform_cdt
+from utils import Substitute, log, memoize
 
 epsilon = 1e-10 # very small non-zero value to avoid division by zero
+connectivity = generate_binary_structure(3, 1) # neighbors as in xyzvrange
+dense_labels_coverage = 0.1 # SpotLabels are dense if spots cover more of cube
+label_chunk_size = 2 ** 20 # pixels of spots looked up in SpotLabels at once
+
+def components(pixels):
+	"""Iterate over connected components of a boolean cube.
+
+	Each component is yielded as bounding box (tuple of slices) and mask.
+	Isolated pixels (having no neighbors) do not form a component.
+	"""
+	labels, _ = label(pixels, connectivity)
+	for n, box in enumerate(find_objects(labels), 1):
+		mask = labels[box] == n
+		if np.count_nonzero(mask) < 2:
+			continue
+		yield box, mask
+
+def spot_flats(spot, shape):
+	"""Return flat indices of pixels of `spot` in a cube of `shape`."""
+	if spot.box is None:
+		coords = spot.uncached_coords()
+		if len(coords) == 0:
+			return np.zeros(0, int)
+		return np.ravel_multi_index(
+			tuple(np.asarray(coord).astype(int) for coord in coords), shape)
+	strides = np.cumprod((1,) + tuple(shape[:0:-1]))[::-1]
+	axes = np.ix_(*[
+		np.arange(side.start, side.stop) * stride
+		for side, stride in zip(spot.box, strides)])
+	return sum(axes)[spot.mask]
+
+def spot_pixels(spot):
+	"""Return number of pixels of `spot`, counting repeated pixels."""
+	if spot.box is not None:
+		return np.count_nonzero(spot.mask)
+	coords = spot.uncached_coords()
+	return len(coords[0]) if len(coords) else 0
+
+def spot_chunks(spots, size):
+	"""Iterate over (start, chunk) of consecutive `spots` of about `size` pixels.
+
+	A spot larger than `size` is a chunk on its own.
+	"""
+	start = pixels = 0
+	for n, spot in enumerate(spots):
+		pixels += spot_pixels(spot)
+		if pixels >= size:
+			yield start, spots[start:n + 1]
+			start, pixels = n + 1, 0
+	if start < len(spots):
+		yield start, spots[start:]
+
+def labelled_pixels(spots, shape):
+	"""Return flat indices of pixels of `spots` in a cube of `shape`.
+
+	Return also the index in `spots` of the spot of each pixel. Pixels
+	repeated within a spot are kept.
+	"""
+	flats = [spot_flats(spot, shape) for spot in spots]
+	rows = np.repeat(np.arange(len(flats)), map(len, flats))
+	return np.concatenate([np.zeros(0, int)] + flats), rows
+
+def cooccurrence(rows, labels):
+	"""Return sparse contingency table of two labellings of same pixels.
+
+	Return arrays of unique (row, label) pairs and of number of pixels
+	of each pair. The pairs are ordered by their first pixel.
+	"""
+	rows = rows.astype(np.int64)
+	labels = labels.astype(np.int64)
+	span = int(labels.max()) + 1 if len(labels) else 1
+	keys = rows * span + labels
+	# runs of equal pairs of neighbouring pixels are far fewer than pixels
+	starts = np.flatnonzero(np.diff(keys)) + 1
+	starts = np.concatenate([[0], starts]) if len(keys) else starts
+	lengths = np.diff(np.append(starts, len(keys)))
+	keys, first, inverse = np.unique(keys[starts],
+		return_index=True, return_inverse=True)
+	counts = np.bincount(inverse, lengths, len(keys)).astype(int)
+	order = np.argsort(first, kind='mergesort')
+	keys, counts = keys[order], counts[order]
+	return keys // span, keys % span, counts
+
+def overlaps(spots, shape):
+	"""Return matrix of overlaps of `spots` in a cube of `shape`.
+
+	Item [a, b] is the number of pixels of spot a (counting repeated
+	pixels) that are within spot b.
+	"""
+	count = len(spots)
+	flats, rows = labelled_pixels(spots, shape)
+	members = np.unique(flats * count + rows)
+	member_flats, member_rows = members // count, members % count
+	lo = np.searchsorted(member_flats, flats, 'left')
+	n = np.searchsorted(member_flats, flats, 'right') - lo
+	starts = np.repeat(lo - (np.cumsum(n) - n), n)
+	columns = member_rows[np.arange(n.sum()) + starts]
+	rows, columns, counts = cooccurrence(np.repeat(rows, n), columns)
+	result = np.zeros((count, count), int)
+	result[rows, columns] = counts
+	return result
 
 class Spot(object):
+	"""A set of voxels in the cube of `spots`.
+
+	The voxels are either given by `coords`, a Z,Y,X tuple of coordinate
+	arrays (which may contain duplicates), or compactly by `box`, a tuple
+	of slices of the cube, and `mask`, a boolean array of voxels within
+	the box. Coordinates of a compact spot are calculated on request only.
+	"""
+
+	__slots__ = ('spots', 'color', 'box', 'mask', '_coordinates')
 
-	def __init__(self, spots, coords):
+	def __init__(self, spots, coords=None, box=None, mask=None):
 		self.spots = spots
-		self.coords = coords
 		self.color = (255, 255, 255)
+		self.coords = coords
+		self.box = box
+		self.mask = mask
+
+	@property
+	def coords(self):
+		"""Z,Y,X tuple of coordinate arrays of the spot."""
+		if self._coordinates is None and self.box is not None:
+			return tuple(coord + side.start
+				for coord, side in zip(self.mask.nonzero(), self.box))
+		if self._coordinates is None:
+			self._coordinates = self._coords()
+		return self._coordinates
+
+	@coords.setter
+	def coords(self, coords):
+		self._coordinates = coords
+		self.box = self.mask = None
+		self._changed()
+
+	def _changed(self):
+		"""Forget tables of the owner that include self."""
+		self.spots.forget(self)
+
+	def _row(self, cube=None):
+		"""Return stats table of the owner and row of self, if there is one."""
+		if cube is not None and cube is not self.spots.cube:
+			return None, None
+		stats = self.spots.stats()
+		return stats, stats.rows.get(self)
+
+	def _coords(self):
+		"""Calculate coordinates of a spot that has none given."""
+		return ()
+
+	def uncached_coords(self):
+		"""Return coordinates of the spot, not keeping calculated ones."""
+		if self.box is None and self._coordinates is None:
+			return self._coords()
+		return self.coords
+
+	def bounds(self):
+		"""Return bounding box of the spot as a tuple of slices."""
+		if self.box is not None:
+			return self.box
+		stats, row = self._row()
+		if row is not None:
+			return tuple(
+				slice(start, stop)
+				for start, stop in zip(stats.start[row], stats.stop[row]))
+		if len(self.coords[0]) == 0:
+			return (slice(0, 0),) * 3
+		return tuple(
+			slice(int(np.min(coord)), int(np.max(coord)) + 1)
+			for coord in self.coords)
+
+	def cropped(self):
+		"""Return bounding box and mask of the spot."""
+		if self.box is not None:
+			return self.box, self.mask
+		coords = [np.asarray(coord, dtype=int) for coord in self.coords]
+		box = self.bounds()
+		mask = np.zeros(tuple(side.stop - side.start for side in box), bool)
+		mask[tuple(coord - side.start for coord, side in zip(coords, box))] = 1
+		return box, mask
+
+	def compact(self):
+		"""Store the spot as bounding box and mask. Return self."""
+		if self.box is None:
+			self.box, self.mask = self.cropped()
+			self._coordinates = None
+		return self
+
+	def fill(self, cube, value):
+		"""Set pixels of the spot in `cube` to `value`."""
+		if self.box is not None:
+			cube[self.box][self.mask] = value
+		else:
+			cube[tuple(self.coords)] = value
+		if cube is self.spots.cube:
+			self.spots.forget_stats()
+
+	def labels(self, spots):
+		"""Return ids of `spots` at pixels of self, null outside of them."""
+		flats, _ = labelled_pixels([self], spots.cube.shape)
+		return spots.labels().at(flats)
+
+	def voxels(self, cube=None):
+		"""Return array of values of `cube` within the spot."""
+		if cube is None:
+			cube = self.spots.cube
+		if self.box is not None:
+			return cube[self.box][self.mask]
+		return cube[tuple(self.coords)]
 
 	def size(self):
 		"""Return number of pixels in the spot."""
+		stats, row = self._row()
+		if row is not None:
+			return int(stats.size[row])
+		if self.box is not None:
+			return np.count_nonzero(self.mask)
 		return len(self.coords[0])
 
 	def mass(self, cube=None):
 		"""Return sum of pixel values in the spot."""
-		cube = cube or self.spots.cube
-		return np.sum(cube[self.coords])
+		stats, row = self._row(cube)
+		if row is not None:
+			return stats.mass[row]
+		return np.sum(self.voxels(cube))
 
 	def center(self):
 		"""Return center of mass of the spot as a Z,Y,X tuple."""
+		stats, row = self._row()
+		if row is not None:
+			return tuple(stats.center[row])
 		return tuple(map(np.mean, self.coords))
 
 	def center_of_mass(self, cube=None):
 		"""Return center of mass of the spot as a Z,Y,X tuple."""
-		cube = cube or self.spots.cube
+		stats, row = self._row(cube)
+		if row is not None:
+			return tuple(stats.center_of_mass[row])
+		weights = self.voxels(cube) + epsilon
 		return tuple(
-			np.average(coord, weights=cube[self.coords] + epsilon)
+			np.average(coord, weights=weights)
 			for coord in self.coords
 		)
 
 	def values(self, cube=None):
 		"""Return sorted list of pixel values in the spot."""
-		cube = cube or self.spots.cube
-		return sorted(cube[self.coords].tolist())
+		return sorted(self.voxels(cube).tolist())
 
 	def quantile(self, quantile, cube=None):
 		"""Find quantile value for the spot."""
@@ -75,27 +292,56 @@ class Spot(object):
 
 	def occupancy(self, level, cube=None):
 		"""Return number of pixels above `level` in the spot."""
-		cube = cube or self.spots.cube
-		return np.count_nonzero(cube[self.coords] > level)
+		return np.count_nonzero(self.voxels(cube) > level)
 
 	def expanded(self, d=1, spots=None):
-		"""Return a copy of the spot expanded by the given dimensions."""
-		Z, Y, X = self.spots.cube.shape
-		coords = set(map(tuple, np.transpose(self.coords).tolist()))
-		for coord in set(coords):
-			coords |= set(xyzrange(coord, d))
-		coords = [(z, y, x) for z, y, x in coords
-			if 0 <= z < Z and 0 <= y < Y and 0 <= x < X]
-		return Spot(spots or self.spots, zip(*coords))
+		"""Return a copy of the spot expanded by the given dimensions.
+
+		`d` is either a number or a Z,Y,X tuple of numbers of pixels to add
+		on each side. The expanded spot is clipped to the cube.
+		"""
+		if not isinstance(d, tuple):
+			d = d, d, d
+		box, mask = self.cropped()
+		grown = tuple(
+			slice(max(side.start - r, 0), min(side.stop + r, size))
+			for side, r, size in zip(box, d, self.spots.cube.shape))
+		inner = tuple(
+			slice(side.start - outer.start, side.stop - outer.start)
+			for side, outer in zip(box, grown))
+		result = np.zeros([side.stop - side.start for side in grown], 'uint8')
+		result[inner] = mask
+		result = maximum_filter(result, [2 * r + 1 for r in d], mode='constant')
+		return Spot(spots or self.spots, box=grown, mask=result.view(bool))
+
+	def flattened(self, spots=None):
+		"""Return projection of the spot onto the plane z=0."""
+		box, mask = self.cropped()
+		box = (slice(0, 1),) + box[1:]
+		return Spot(spots or self.spots, box=box, mask=mask.any(0)[np.newaxis])
 
 	def draw_3D(self, images):
-		# XXX: this is the point of slowness; it must be done via numpy
-		for z, y, x in set(zip(*self.coords)):
-			images.images[z].putpixel((x, y), self.color)
+		"""Paint the spot on a stack of images."""
+		box, mask = self.cropped()
+		z0, y0, x0 = (side.start for side in box)
+		for z, plane in enumerate(mask, z0):
+			if plane.any():
+				stencil = Image.fromarray(plane.astype('uint8') * 255)
+				images.images[z].paste(self.color, (x0, y0), stencil)
 
 	def __isub__(self, other):
-		coords = set(zip(*self.coords)) - set(zip(*other.coords))
-		self.coords = zip(*coords)
+		self.compact()
+		other_box, other_mask = other.cropped()
+		common = tuple(
+			slice(max(a.start, b.start), min(a.stop, b.stop))
+			for a, b in zip(self.box, other_box))
+		if all(side.start < side.stop for side in common):
+			relative = lambda box: tuple(
+				slice(side.start - start.start, side.stop - start.start)
+				for side, start in zip(common, box))
+			self.mask = self.mask.copy()
+			self.mask[relative(self.box)] &= ~other_mask[relative(other_box)]
+			self._changed()
 		return self
 
 	def intersection_spots(self, spots):
@@ -104,14 +350,11 @@ class Spot(object):
 
 	def intersection_ids(self, spots):
 		"""Return a list of ids spots from `spots` that intersect `self`."""
-		spots.assign_spots_cube()
-		return set(spots.spots_cube[self.coords]) - set([spots.spots_cube_null])
+		return spots.intersection_ids([self])[0]
 
 	def intersection_occupancy(self, spots):
 		"""Return size of intersection with any spot in `spots`."""
-		spots.assign_spots_cube()
-		non_null = spots.spots_cube[self.coords] != spots.spots_cube_null
-		return np.count_nonzero(non_null)
+		return int(spots.intersection_occupancy([self])[0])
 
 	def to_physical_volume(self, volume):
 		"""Convert volume in voxels to physical volume in nm^3."""
@@ -131,75 +374,136 @@ class Spot(object):
 		c2 = np.array(other.center_of_mass()) * other.spots.images.scale
 		return np.linalg.norm(c1 - c2)
 
-	def distance_to_variety(self, spots, max_distance=20, d=1):
+	def distance_to_variety(self, spots, max_distance=20, d=1, layers=False):
 		"""Return distance to any spot of the given set.
 
 		If self is within a spot of the given set, return distance to it's border.
 
-		The distance is calculated by growing layers around self with expand.
+		The distance is the number of layers of size `d` to grow around self
+		with expand. Unless `layers` is set, it is looked up in the
+		`distance_cube` of `spots`, which is only available for `d` made
+		of zeros and ones.
 		"""
-		spots.assign_spots_cube()
-		spot = self
-		for n in range(max_distance):
-			if len(set(spots.spots_cube[spot.coords])) != 1:
-				return n
-			spot = spot.expanded(d)
+		if not isinstance(d, tuple):
+			d = d, d, d
+		if layers or not set(d) <= set([0, 1]):
+			spot = self
+			for n in range(max_distance):
+				if len(set(spot.labels(spots))) != 1:
+					return n
+				spot = spot.expanded(d)
+			return
+		if len(set(self.labels(spots))) != 1:
+			return 0
+		n = self.voxels(spots.distance_cube(d)).min()
+		if n < max_distance:
+			return n
 
 	def center_to_variety(self, spots, max_distance=20, d=1):
 		"""Return distance to any spot of the given set.
 
 		If self is within a spot of the given set, return distance to it's border.
 
-		The distance is calculated by fitting ellipsoid within center of mass.
+		The distance is the smallest n such that an ellipsoid with radii d*n
+		(rounded down) around center of mass reaches a different spot.
 		"""
 		if not isinstance(d, tuple):
 			d = d, d, d
-		d = np.array(d)
 		center = self.center_of_mass()
-		spots.assign_spots_cube()
 		for n in range(max_distance):
-			spot = Ellipsoid(self.spots, center, (d*n).astype('int'))
-			if len(set(spots.spots_cube[spot.coords])) != 1:
+			spot = Ellipsoid(self.spots, center, (np.array(d)*n).astype('int'))
+			if len(set(spot.labels(spots))) != 1:
 				return n
 
+class Stencil(object):
+	"""Shape of a spot relative to its center.
+
+	The shape is given by `mask`, which starts at `corner` relative to the
+	center, and by `offsets`, coordinates of the shape within the mask.
+	The arrays are shared between spots and are read-only.
+	"""
+
+	def __init__(self, mask, corner):
+		box = find_objects(mask.astype('uint8'))[0]
+		self.mask = mask[box]
+		self.corner = tuple(c + side.start for c, side in zip(corner, box))
+		self.offsets = self.mask.nonzero()
+		for array in (self.mask,) + self.offsets:
+			array.flags.writeable = False
+
+	def place(self, navel, shape):
+		"""Return box of the stencil at `navel` if it is within `shape`."""
+		box = tuple(
+			slice(int(v) + c, int(v) + c + n)
+			for v, c, n in zip(navel, self.corner, self.mask.shape))
+		if all(0 <= side.start and side.stop <= size
+				for side, size in zip(box, shape)):
+			return box
+
+	def coords(self, navel, shape):
+		"""Return coordinates of the stencil at `navel`, clipped to `shape`."""
+		return tuple(
+			(offset + (int(v) + c)).clip(0, size - 1)
+			for offset, v, c, size in zip(self.offsets, navel, self.corner, shape))
+
+@memoize()
+def ellipsoid_stencil(radii):
+	"""Return stencil of an ellipsoid with Z,Y,X `radii`."""
+	z, y, x = [
+		np.linspace(-1, 1, num=int(2*radius))
+		for radius in radii
+	]
+	x = x[np.newaxis, np.newaxis, :]
+	y = y[np.newaxis, :, np.newaxis]
+	z = z[:, np.newaxis, np.newaxis]
+	distance_squared = x ** 2 + y ** 2 + z ** 2
+	return Stencil(distance_squared <= 1, [-int(radius) for radius in radii])
+
+@memoize()
+def disc_stencil(radii):
+	"""Return stencil of a cylinder section with Y,X `radii`."""
+	x = np.linspace(-1, 1, num=int(2*radii[-2]))
+	y = np.linspace(-1, 1, num=int(2*radii[-1]))[:, np.newaxis]
+	return Stencil(x ** 2 + y ** 2 <= 1, [-int(radius) for radius in radii])
+
 class Ellipsoid(Spot):
 	"""Elliptical spot.
 	
 	The spot is defined by it's center (called navel) and three radii.
 
 	The ellipsoid is always coaligned with the XYZ axes.
+
+	Ellipsoids within the cube are stored compactly, with the shared mask
+	of their stencil. Coordinates of ellipsoids clipped by the cube
+	borders are only calculated when requested.
 	"""
 
+	__slots__ = ('navel', 'radii')
+
 	def __init__(self, spots, navel, radii):
-		Spot.__init__(self, spots, ())
+		Spot.__init__(self, spots)
 		self.navel = navel
 		self.radii = tuple(max(v, 1.5) for v in radii)
-		self.coords = self._coords()
+		self._place()
 
 	def with_radii(self, radii):
 		"""Return a copy of self with different `radii`."""
 		return self.__class__(self.spots, self.navel, radii)
 
+	def stencil(self):
+		"""Return stencil of the spot."""
+		return ellipsoid_stencil(self.radii)
+
+	def _place(self):
+		"""Use compact storage if the spot fits in the cube."""
+		stencil = self.stencil()
+		self.box = stencil.place(self.navel, self.spots.cube.shape)
+		if self.box is not None:
+			self.mask = stencil.mask
+
 	def _coords(self):
-		"""Calculate coordinates for the ellipsoid"""
-		z, y, x = [
-			np.linspace(-1, 1, num=int(2*radius))
-			for radius in self.radii
-		]
-		x = x[np.newaxis, np.newaxis, :]
-		y = y[np.newaxis, :, np.newaxis]
-		z = z[:, np.newaxis, np.newaxis]
-		distance_squared = x ** 2 + y ** 2 + z ** 2
-		return self._shift(np.where(distance_squared <= 1))
-
-	def _shift(self, coords):
-		"""Shift coords from center=radii to center=navel. Clip to cube."""
-		v_column = lambda v: np.array(v, dtype='int').reshape((3,1))
-		coords = np.array(coords) - v_column(self.radii) + v_column(self.navel)
-		return tuple(
-			coords[coord].clip(0, size - 1)
-			for coord, size in enumerate(self.spots.cube.shape)
-		)
+		"""Calculate coordinates for the ellipsoid, clipped to the cube."""
+		return self.stencil().coords(self.navel, self.spots.cube.shape)
 
 	def optimize_navel(self, iterations=5):
 		"""Optimize the brightness of the whole ellipsoid by moving center."""
@@ -210,25 +514,255 @@ class Ellipsoid(Spot):
 					break
 			candidate = self.__class__(self.spots, next_navel, self.radii)
 		self.navel = candidate.navel
-		self.coords = candidate.coords
+		self.coords = candidate._coordinates
+		self.box, self.mask = candidate.box, candidate.mask
 
 	def wipe(self):
 		"""Wipe everything under `self`."""
-		self.spots.cube[self.coords] = 0
+		self.fill(self.spots.cube, 0)
 
 class Cylinder(Ellipsoid):
+	"""Circular spot spanning all layers of the cube.
+
+	Coordinates of the cylinder are only calculated when requested.
+	"""
+
+	__slots__ = ()
+
+	def __init__(self, spots, navel, radii):
+		Spot.__init__(self, spots)
+		# z-radius and navel.z are zero, the cylinder spans all layers
+		self.radii = (0,) + tuple(max(v, 1.5) for v in radii[-2:])
+		self.navel = (0,) + tuple(navel[-2:])
+		self._place()
+
+	def stencil(self):
+		"""Return stencil of the cylinder section."""
+		return disc_stencil(self.radii[1:])
+
+	def _place(self):
+		"""Use compact storage if the spot fits in the cube."""
+		depth = self.spots.cube.shape[0]
+		stencil = self.stencil()
+		box = stencil.place(self.navel[1:], self.spots.cube.shape[1:])
+		if box is not None:
+			self.box = (slice(0, depth),) + box
+			self.mask = np.broadcast_to(stencil.mask, (depth,) + stencil.mask.shape)
 
 	def _coords(self):
 		"""Calculate coordinates for the cylinder"""
-		x = np.linspace(-1, 1, num=int(2*self.radii[-2]))
-		y = np.linspace(-1, 1, num=int(2*self.radii[-1]))[:, np.newaxis]
-		z = np.zeros(shape=(self.spots.cube.shape[0], 1, 1))
-		d = x ** 2 + y ** 2 + z ** 2
-		# assert z-radius and navel.z are zero
-		# in order for _shift to not move the cylinder along z axis
-		self.radii = (0,) + tuple(self.radii[-2:])
-		self.navel = (0,) + tuple(self.navel[-2:])
-		return self._shift(np.where(d <= 1))
+		y, x = self.section()
+		depth = self.spots.cube.shape[0]
+		z = np.arange(depth).repeat(len(y))
+		return z, np.tile(y, depth), np.tile(x, depth)
+
+	def section(self):
+		"""Return Y,X coordinates of the cylinder section, clipped to cube."""
+		return self.stencil().coords(self.navel[1:], self.spots.cube.shape[1:])
+
+	def projected_center_of_mass(self, sums, z_sums):
+		"""Return center of mass of the spot as a Z,Y,X tuple.
+
+		`sums` and `z_sums` are sums of `cube` and `z * cube` over Z axis.
+		"""
+		depth = self.spots.cube.shape[0]
+		y, x = self.section()
+		weights = sums[y, x] + depth * epsilon
+		z = (z_sums[y, x] + depth * (depth - 1) / 2 * epsilon).sum()
+		return (
+			z / weights.sum(),
+			np.average(y, weights=weights),
+			np.average(x, weights=weights),
+		)
+
+class BlockMax(object):
+	"""Position of maximum of a changing cube.
+
+	The cube is split into blocks of shape `block`, and maximum of each block
+	is remembered. When a part of the cube changes, only blocks intersecting
+	it need to be scanned again. Ties are resolved the same way as by
+	np.argmax.
+
+	If `order` cube is given, among equal maxima the one with the lowest
+	value in `order` is preferred.
+	"""
+
+	def __init__(self, cube, block=(8, 64, 64), order=None):
+		self.cube = cube
+		self.order = order
+		self.block = tuple(min(b, size) for b, size in zip(block, cube.shape))
+		grid = tuple(-(-size // b) for size, b in zip(cube.shape, self.block))
+		self.values = np.zeros(grid, cube.dtype)
+		self.positions = np.zeros(grid, int)
+		if order is not None:
+			self.orders = np.zeros(grid, order.dtype)
+		self.update(tuple(slice(0, size) for size in cube.shape))
+
+	def update(self, box):
+		"""Rescan all blocks intersecting `box` (a tuple of slices)."""
+		blocks = [
+			range(side.start // b, (side.stop - 1) // b + 1)
+			for side, b in zip(box, self.block)]
+		for index in product(*blocks):
+			part = tuple(slice(n * b, (n + 1) * b) for n, b in zip(index, self.block))
+			values = self.cube[part]
+			if self.order is None:
+				top = np.argmax(values)
+			else:
+				ties = np.flatnonzero(values == values.max())
+				top = ties[np.argmin(self.order[part].flat[ties])]
+				self.orders[index] = self.order[part].flat[top]
+			top = np.unravel_index(top, values.shape)
+			self.values[index] = values[top]
+			self.positions[index] = np.ravel_multi_index(
+				[n + side.start for n, side in zip(top, part)], self.cube.shape)
+
+	def argmax(self):
+		"""Return position of maximum in the cube as a tuple."""
+		ties = self.values == self.values.max()
+		positions = self.positions[ties]
+		if self.order is not None:
+			orders = self.orders[ties]
+			positions = positions[orders == orders.min()]
+		return np.unravel_index(positions.min(), self.cube.shape)
+
+class Histogram(object):
+	"""Histogram of a uint8 cube, answering order statistics in O(256).
+
+	`zeros` more zero pixels may be counted in.
+	"""
+
+	def __init__(self, cube, zeros=0):
+		counts = np.bincount(cube.ravel(), minlength=256)
+		counts[0] += zeros
+		self.cube = cube
+		self.cumulative = counts.cumsum()
+		self.total = self.cumulative[-1]
+
+	def nth(self, n):
+		"""Return n-th smallest value, counting from 0."""
+		return np.argmax(self.cumulative > n)
+
+	def top(self, k):
+		"""Return k-th largest value, the same as found by argpartition."""
+		return self.nth(self.total - k)
+
+	def percentile(self, q):
+		"""Return q-th percentile of values, the same as np.percentile."""
+		index = q / 100.0 * (self.total - 1)
+		below = int(np.floor(index))
+		above = min(below + 1, self.total - 1)
+		weight = index - below
+		return self.nth(below) * (1.0 - weight) + self.nth(above) * weight
+
+class SpotStats(object):
+	"""Table of statistics of `spots`, with one row per spot.
+
+	Columns are arrays: `size` and `mass`, Z,Y,X rows of `center`,
+	`center_of_mass` and of the bounding box `start` and `stop`, and
+	`layers`, number of pixels of the spot in each layer of the cube.
+
+	Spots may overlap, so the statistics are not gathered from a label
+	cube but spot by spot. Coordinates are only held for one spot at a
+	time, and lazy coordinates of spots are not kept.
+	"""
+
+	def __init__(self, spots):
+		self.cube = spots.cube
+		self.spots = spots.spots
+		self.count = count = len(self.spots)
+		self.rows = dict((spot, n) for n, spot in enumerate(self.spots))
+		self.size = np.zeros(count, int)
+		self.mass = np.zeros(count, np.sum(self.cube[:0]).dtype)
+		self.center = np.empty((count, 3))
+		self.center_of_mass = np.empty((count, 3))
+		self.start = np.zeros((count, 3), int)
+		self.stop = np.zeros((count, 3), int)
+		self.layers = np.zeros((count, self.cube.shape[0]), int)
+		for row, spot in enumerate(self.spots):
+			self._add(row, spot)
+
+	def _add(self, row, spot):
+		coords = spot.uncached_coords()
+		coords = [np.asarray(coord).astype(int) for coord in coords or ([],) * 3]
+		values = self.cube[tuple(coords)]
+		weights = values + epsilon
+		size = self.size[row] = len(values)
+		self.mass[row] = np.sum(values)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			self.center[row] = [coord.sum() / float(size) for coord in coords]
+			self.center_of_mass[row] = [
+				(coord * weights).sum() / weights.sum() for coord in coords]
+		if size:
+			self.start[row] = [coord.min() for coord in coords]
+			self.stop[row] = [coord.max() + 1 for coord in coords]
+			self.layers[row] = np.bincount(coords[0],
+				minlength=self.cube.shape[0])
+
+class SpotLabels(object):
+	"""Index of ids of `spots` covering pixels of the cube.
+
+	Where spots overlap, the last one wins. Covered pixels are kept as
+	sorted flat indices with the spot ids; the id of other pixels is
+	`null`. A dense cube of ids is only built on request, or instead of
+	the index if spots cover much of the cube.
+	"""
+
+	def __init__(self, spots):
+		self.spots = spots.spots
+		self.count = len(self.spots)
+		self.shape = spots.cube.shape
+		self.rows = dict((spot, n) for n, spot in enumerate(self.spots))
+		self.null = self.count + 1
+		self.flats = self.ids = self.dense = None
+		self.distance_cubes = {}
+		pixels = sum(spot_pixels(spot) for spot in self.spots)
+		if pixels > dense_labels_coverage * np.prod(self.shape):
+			self.cube()
+			return
+		flats, ids = labelled_pixels(self.spots, self.shape)
+		# stable sort keeps pixels of later spots at the end of each run
+		order = np.argsort(flats, kind='mergesort')
+		flats, ids = flats[order], ids[order]
+		last = np.ones(len(flats), bool)
+		last[:-1] = flats[1:] != flats[:-1]
+		self.flats, self.ids = flats[last], ids[last]
+
+	def at(self, flats):
+		"""Return ids of spots at pixels with flat indices `flats`."""
+		if self.flats is None:
+			return self.dense.ravel()[flats]
+		if len(self.flats) == 0:
+			return np.repeat(self.null, len(flats))
+		where = np.searchsorted(self.flats, flats).clip(0, len(self.flats) - 1)
+		return np.where(self.flats[where] == flats, self.ids[where], self.null)
+
+	def covered(self, size):
+		"""Iterate over (flats, ids) of covered pixels, `size` pixels at once."""
+		if self.flats is not None:
+			for start in range(0, len(self.flats), size):
+				yield (self.flats[start:start + size],
+					self.ids[start:start + size])
+			return
+		flat = self.dense.ravel()
+		for start in range(0, len(flat), size):
+			ids = flat[start:start + size]
+			inside = np.flatnonzero(ids != self.null)
+			yield inside + start, ids[inside]
+
+	def cube(self):
+		"""Return cube of ids of spots, uint16 unless there are too many."""
+		if self.dense is None:
+			dtype = 'uint16' if self.null < 2 ** 16 else 'int32'
+			self.dense = np.empty(self.shape, dtype=dtype)
+			self.dense.fill(self.null)
+			flat = self.dense.ravel()
+			if self.flats is None:
+				for n, spot in enumerate(self.spots):
+					flat[spot_flats(spot, self.shape)] = n
+			else:
+				flat[self.flats] = self.ids
+		return self.dense
 
 class Spots(object):
 
@@ -238,79 +772,163 @@ class Spots(object):
 			return
 		self.cube = cube
 		self.images = images
-		self.pixels = set()
+		self.pixels = None
 		self.spots = []
 		self.has_colors = False
-		self.spots_cube = None
 		self.darkness_cube = None
+		self._stats = None
+		self._labels = None
+		self._histogram = None
+		self.hidden_zeros = 0 # zero pixels of the image outside of cube
+
+	def stats(self):
+		"""Return SpotStats of the spots, computed once for the spots list."""
+		stats = self._stats
+		if (stats is None or stats.cube is not self.cube
+				or stats.spots is not self.spots
+				or stats.count != len(self.spots)):
+			stats = self._stats = SpotStats(self)
+		return stats
+
+	def forget_stats(self):
+		"""Drop SpotStats after spots or the cube were changed in place."""
+		self._stats = None
+		self._histogram = None
+
+	def histogram(self):
+		"""Return Histogram of the uint8 cube, computed once for the cube."""
+		histogram = self._histogram
+		if histogram is None or histogram.cube is not self.cube:
+			histogram = Histogram(self.cube, zeros=self.hidden_zeros)
+			self._histogram = histogram
+		return histogram
+
+	def top_level(self, voxels):
+		"""Return level of the brightest `voxels` pixels of the cube."""
+		if self.cube.dtype == np.uint8:
+			return self.histogram().top(voxels)
+		where = self.cube.argpartition(-voxels, axis=None)[-voxels]
+		return self.cube.flat[where]
+
+	def percentile_level(self, percentile):
+		"""Return `percentile` of pixel values of the cube."""
+		if self.cube.dtype == np.uint8:
+			return self.histogram().percentile(percentile)
+		return np.percentile(self.cube, percentile)
+
+	def labels(self):
+		"""Return SpotLabels of the spots, computed once for the spots list."""
+		labels = self._labels
+		if (labels is None or labels.shape != self.cube.shape
+				or labels.spots is not self.spots
+				or labels.count != len(self.spots)):
+			labels = self._labels = SpotLabels(self)
+		return labels
+
+	def forget(self, spot=None):
+		"""Drop tables including `spot` (any spot if None) after it changed."""
+		for name in ('_stats', '_labels'):
+			table = getattr(self, name)
+			if table is not None and (spot is None or spot in table.rows):
+				setattr(self, name, None)
+
+	@property
+	def spots_cube(self):
+		"""Cube of ids of spots, `spots_cube_null` outside of them."""
+		return self.labels().cube()
+
+	@property
+	def spots_cube_null(self):
+		"""Id of pixels outside of spots."""
+		return self.labels().null
 
 	def detect_cc(self, level):
-		"""Detect spots as connected components of intensive pixels."""
+		"""Detect spots as connected components of intensive pixels.
+
+		Spots are ordered by their first pixel in Z,Y,X raster order.
+		"""
 		self.assign_pixels(level)
-		edges = {}
-		for pixel in self.pixels:
-			for other in xyzvrange(pixel):
-				if other in self.pixels:
-					edges.setdefault(pixel, []).append(other)
-		self.spots = [Spot(self, zip(*sorted(coords)))
-			for coords in find_components(edges)]
+		self.spots = [Spot(self, box=box, mask=mask)
+			for box, mask in components(self.pixels)]
 		return self
 
 	def detect_spheres(self, n, radius, wipe_radius):
 		"""Detect spots by greedily fitting spheres."""
 		with self.substitute_cube(self.cube.copy()):
 			spheres = []
+			maxima = BlockMax(self.cube)
 			for _ in range(n):
-				navel = np.unravel_index(np.argmax(self.cube), self.cube.shape)
+				navel = maxima.argmax()
 				sphere = Ellipsoid(self, navel, (radius/3, radius, radius))
 				sphere.optimize_navel()
-				sphere.with_radii((wipe_radius/3, wipe_radius, wipe_radius)).wipe()
+				wipe = sphere.with_radii((wipe_radius/3, wipe_radius, wipe_radius))
+				wipe.wipe()
+				maxima.update(wipe.bounds())
 				spheres.append(sphere)
 			self.spots = spheres
 		return self
 
-	def detect_cylinders(self, n, radius, wipe_radius):
-		"""Detect spots by greedily fitting spheres."""
-		with self.substitute_cube(self.cube.copy()):
-			spheres = []
-			for _ in range(n):
-				navel = np.unravel_index(np.argmax(self.cube), self.cube.shape)
+	def detect_cylinders(self, n, radius, wipe_radius, iterations=5):
+		"""Detect spots by greedily fitting cylinders.
+
+		Cylinders span all layers, so they are fitted to projections of the
+		cube along Z axis; wiping a cylinder zeroes its section.
+		"""
+		depth = self.cube.shape[0]
+		sums = self.cube.sum(0, dtype='float64')
+		z_sums = np.tensordot(np.arange(depth, dtype='float64'), self.cube, 1)
+		tops = self.cube.max(0)
+		layers = self.cube.argmax(0)
+		maxima = BlockMax(tops, (256, 256), order=layers)
+		cylinders = []
+		for _ in range(n):
+			y, x = maxima.argmax()
+			cylinder = Cylinder(self, (layers[y, x], y, x), (radius, radius))
+			for step in range(iterations): # as in optimize_navel
+				navel = cylinder.projected_center_of_mass(sums, z_sums)
+				if navel == cylinder.navel:
+					break
 				cylinder = Cylinder(self, navel, (radius, radius))
-				cylinder.optimize_navel()
-				cylinder.with_radii((wipe_radius, wipe_radius)).wipe()
-				spheres.append(cylinder)
-			self.spots = spheres
+			y, x = cylinder.with_radii((wipe_radius, wipe_radius)).section()
+			for projection in (sums, z_sums, tops, layers):
+				projection[y, x] = 0
+			maxima.update((slice(y.min(), y.max() + 1), slice(x.min(), x.max() + 1)))
+			cylinders.append(cylinder)
+		self.spots = cylinders
 		return self
 
 	def filter_tight_pixels(self, neighbors=15, distance=1):
-		"""Remove pixels that don't have enough significant neighbors."""
-		self.pixels = [pixel
-			for pixel in self.pixels
-			if neighbors <= len([other
-				for other in xyzrange(pixel, distance)
-				if other in self.pixels])]
+		"""Remove pixels that don't have enough significant neighbors.
+
+		Neighbors are counted (including the pixel itself) in a box of
+		+-`distance` pixels, given either as a number or as a Z,Y,X tuple.
+		"""
+		if not isinstance(distance, tuple):
+			distance = distance, distance, distance
+		counts = self.pixels.astype('int32')
+		for axis, d in enumerate(distance):
+			window = np.ones(2 * d + 1, dtype='int32')
+			counts = correlate1d(counts, window, axis, mode='constant')
+		self.pixels = self.pixels & (counts >= neighbors)
 		return self
 
 	def filter_by_size(self, min_size=None, max_size=None):
 		"""Remove spots not fitting in the given size range."""
 		min_size = min_size or 0
 		max_size = max_size or float("+inf")
+		sizes = self.stats().size
 		self.spots = [spot
-			for spot in self.spots
-			if min_size <= spot.size() <= max_size]
+			for spot, size in zip(self.spots, sizes)
+			if min_size <= size <= max_size]
 		return self
 
 	def filter_by_height(self, min_height=2, min_presence=5):
 		"""Remove spots not spanning given height."""
-		spots, self.spots = self.spots, []
-		for spot in spots:
-			zs = Counter(z for z, y, x in izip(*spot.coords))
-			for z in zs:
-				if zs[z] < min_presence:
-					del zs[z]
-			if len(zs) < min_height:
-				continue
-			self.spots.append(spot)
+		present = self.stats().layers >= max(min_presence, 1)
+		heights = np.count_nonzero(present, axis=1)
+		self.spots = [spot
+			for spot, height in zip(self.spots, heights)
+			if height >= min_height]
 		return self
 
 	def filter_by_mass(self, percentile=0.5, min_ratio=0.5, max_ratio=2.0):
@@ -320,7 +938,7 @@ class Spots(object):
 		Retain spots that have mass within [M*min_ratio, M*max_ratio] range.
 		Return self.
 		"""
-		masses = [self.cube[spot.coords].sum() for spot in self.spots]
+		masses = self.stats().mass
 		reference = np.percentile(masses, percentile)
 		self.spots = [ spot
 			for spot, mass in zip(self.spots, masses)
@@ -334,6 +952,23 @@ class Spots(object):
 		result.spots = [spot.expanded(d, spots=result) for spot in self.spots]
 		return result
 
+	def expanded_series(self, ds):
+		"""Return list of sets of spots expanded by each of `ds`.
+
+		Each set is grown from the previous one when it is nested within.
+		"""
+		results = []
+		base, base_d = self, (0, 0, 0)
+		for d in ds:
+			if not isinstance(d, tuple):
+				d = d, d, d
+			if not all(a <= b for a, b in zip(base_d, d)):
+				base, base_d = self, (0, 0, 0)
+			base = base.expanded(tuple(b - a for a, b in zip(base_d, d)))
+			base_d = d
+			results.append(base)
+		return results
+
 	def ellipsoids(self, radii=(0,1,1)):
 		"""Return set of spots replaced by ellipsoids with given radii."""
 		result = Spots(self.cube, images=self.images)
@@ -355,10 +990,9 @@ class Spots(object):
 		return self
 
 	def assign_pixels(self, level, force=False):
-		"""Detect list of coordinates of pixels above level."""
-		if force or not self.pixels:
-			coords = (self.cube > level).nonzero()
-			self.pixels = set(izip(*coords))
+		"""Detect mask of pixels above level."""
+		if force or self.pixels is None or not self.pixels.any():
+			self.pixels = self.cube > level
 		return self
 
 	def assign_darkness(self, percentile=90, force=False):
@@ -414,16 +1048,74 @@ class Spots(object):
 		self.cube = cube
 		return self
 
+	def cooccurrence(self, spots):
+		"""Return contingency table of pixels of `spots` and ids of self.
+
+		Return arrays of index in `spots` list, id of spot of self (or
+		`spots_cube_null`) and number of pixels of the spot with the id,
+		ordered by first pixel.
+		"""
+		labels = self.labels()
+		tables = [(np.zeros(0, int),) * 3]
+		for start, chunk in spot_chunks(spots, label_chunk_size):
+			flats, rows = labelled_pixels(chunk, self.cube.shape)
+			rows, ids, counts = cooccurrence(rows, labels.at(flats))
+			tables.append((rows + start, ids, counts))
+		return tuple(map(np.concatenate, zip(*tables)))
+
+	def intersection_ids(self, spots):
+		"""Return sets of ids of spots intersecting each of `spots` list."""
+		rows, ids, _ = self.cooccurrence(spots)
+		result = [[] for spot in spots]
+		for row, n in zip(rows.tolist(), ids.tolist()):
+			result[row].append(n)
+		null = set([self.spots_cube_null])
+		return [set(ids) - null for ids in result]
+
+	def intersection_occupancy(self, spots):
+		"""Return sizes of intersections of each of `spots` list with self."""
+		rows, ids, counts = self.cooccurrence(spots)
+		inside = ids != self.spots_cube_null
+		return np.bincount(rows[inside], counts[inside], len(spots)).astype(int)
+
 	def assign_spots_cube(self, force=False):
 		"""Create `self.spots_cube`, with ids of spots in cells."""
-		if force or not self.spots_cube is not None:
-			self.spots_cube_null = len(self.spots) + 1
-			self.spots_cube = np.zeros(self.cube.shape, dtype='uint16')
-			self.spots_cube.fill(self.spots_cube_null)
-			for n, spot in enumerate(self.spots):
-				self.spots_cube[spot.coords] = n
+		if force:
+			self.forget()
+		self.labels().cube()
 		return self
 
+	def distance_cube(self, d=(0, 1, 1)):
+		"""Return cube of distances to the closest pixel of other spot id.
+
+		The distance is the number of steps of size `d` (a Z,Y,X tuple of
+		zeros and ones) from a pixel to a pixel with a different value in
+		`spots_cube`. Pixels that can not reach any other spot id get
+		a distance larger than size of the cube.
+		"""
+		distance_cubes = self.labels().distance_cubes
+		if d not in distance_cubes:
+			step = np.zeros((3, 3, 3), bool)
+			step[tuple(slice(1 - a, 2 + a) for a in d)] = 1
+			ids = self.spots_cube
+			edges = ((maximum_filter(ids, footprint=step, mode='nearest') != ids)
+				| (minimum_filter(ids, footprint=step, mode='nearest') != ids))
+			# steps are chessboard moves along the axes of nonzero `d`,
+			# so transform each line or plane along them
+			distances = np.empty(ids.shape, np.int32)
+			flat = [axis for axis, a in enumerate(d) if not a]
+			if len(flat) == len(d):
+				distances.fill(-1)
+			else:
+				edges_t = np.moveaxis(edges, flat, range(len(flat)))
+				distances_t = np.moveaxis(distances, flat, range(len(flat)))
+				for index in np.ndindex(edges_t.shape[:len(flat)]):
+					distances_t[index] = distance_transform_cdt(~edges_t[index],
+						'chessboard')
+			distances[distances < 0] = distances.size
+			distance_cubes[d] = distances + 1
+		return distance_cubes[d]
+
 	def draw_flat(self, image):
 		"""Draw spots on a flat image."""
 		self.draw_3D(Images(images=[image] * self.cube.shape[0]))
@@ -441,53 +1133,125 @@ class Spots(object):
 		borders = Spots(self)
 		borders.spots = []
 		for spot in self.spots:
-			Z, Y, X = spot.coords
-			Z = [0] * len(Z)
-			flat = Spot(borders, (Z, Y, X))
+			flat = spot.flattened(borders)
 			border = flat.expanded((0, 1, 1), borders)
 			border -= flat
 			borders.spots.append(border)
 		borders.assign_colors_from(self, True)
 		return borders.draw_flat(image)
 
+	def quantiles(self, *quantiles):
+		"""Return array of `quantiles` of pixel values, a row for each spot.
+
+		The values are the same as of `Spot.quantile`. For uint8 pixels
+		they are found in histograms of the spots.
+		"""
+		count = len(self.spots)
+		histograms = np.zeros((count, 256), int)
+		for histogram, spot in zip(histograms, self.spots):
+			voxels = spot.voxels()
+			if voxels.dtype != np.uint8:
+				return np.array([
+					[spot.quantile(quantile) for quantile in quantiles]
+					for spot in self.spots
+				]).reshape(count, len(quantiles))
+			histogram[:] = np.bincount(voxels, minlength=256)
+		cumulative = histograms.cumsum(1)
+		ranks = np.multiply.outer(histograms.sum(1), quantiles).astype(int)
+		return np.transpose([
+			np.argmax(cumulative > rank[:, np.newaxis], axis=1)
+			for rank in ranks.T
+		]).reshape(count, len(quantiles))
+
 	def normalized_cube(self, quantile=0.75, level=100):
 		"""Return cube, normalized in spots by shifting pixel values."""
-		result = np.zeros(self.cube.shape, dtype='int16')
-		for spot in self.spots:
-			offset = level - spot.quantile(quantile)
-			res = self.cube[spot.coords].astype('int16') + offset
-			res *= (res >= level) * 0.5 + 0.5 # half all values below level
-			result[spot.coords] = res
-		return result.clip(0, 255).astype('uint8')
+		offsets = (level - self.quantiles(quantile)[:, 0]).astype('int16')
+		result = np.zeros(self.cube.shape, 'uint8')
+		cube, flat = np.ravel(self.cube), result.ravel()
+		for flats, ids in self.labels().covered(label_chunk_size):
+			values = cube[flats].astype('int16') + offsets[ids]
+			# half all values below level
+			values = np.where(values >= level, values, values // 2)
+			flat[flats] = values.clip(0, 255)
+		return result
 
 	def stretched_cube(self, quantile1=0.2, quantile2=0.2):
 		"""Return cube, normalized in spots by stretching histogram."""
-		result = np.zeros(self.cube.shape)
-		for spot in self.spots:
-			low, high = spot.quantile(quantile1), spot.quantile(1.0 - quantile2)
-			frag = self.cube[spot.coords].astype('float64')
-			res = (frag - low) * 256.0 / (high - low)
-			result[spot.coords] = res
-		return result.clip(0, 255).astype('uint8')
+		bounds = self.quantiles(quantile1, 1.0 - quantile2).astype('float64')
+		result = np.zeros(self.cube.shape, 'uint8')
+		cube, flat = np.ravel(self.cube), result.ravel()
+		for flats, ids in self.labels().covered(label_chunk_size):
+			low, high = bounds[ids, 0], bounds[ids, 1]
+			with np.errstate(divide='ignore', invalid='ignore'):
+				values = (cube[flats] - low) * 256.0 / (high - low)
+			flat[flats] = values.clip(0, 255)
+		return result
 
 	def substitute_cube(self, cube):
 		"""Use different cube but keep the detected spots."""
 		return Substitute(self, 'cube', cube)
 
 class Images(object):
+	"""Stack of RGB images, and three color cubes of it.
+
+	Images of cubes are made of the cubes as of `from_cubes` when first
+	used, so the cubes may be replaced later without changing the images.
+
+	Clones share cubes: change them in place via `writable_cube` only.
+	"""
+
 	def __init__(self, filenames=None, images=()):
 		if filenames:
 			images = [Image.open(f).convert('RGB') for f in filenames]
 		self.images = images
 		self.cubes = (None, None, None)
+		self._shared = set() # channels of cubes shared with clones
+		self._flat = {} # channel: (cube, max projection of cube)
+
+	@property
+	def images(self):
+		if self._images is None:
+			self._images = self._make_images(self._image_cubes)
+		return self._images
+
+	@images.setter
+	def images(self, images):
+		self._images = images
+		self._image_cubes = None
+
+	@staticmethod
+	def _make_images(cubes):
+		im = {}
+		for c, cube in enumerate(cubes):
+			for z in range(cube.shape[0]):
+				shape = tuple(reversed(cube[z].shape))[:2]
+				im[c,z] = Image.frombytes("L", shape, cube[z].tostring())
+		return [
+			Image.merge("RGB", (im[0,z], im[1,z], im[2,z]))
+			for z in range(cube.shape[0])
+		]
 
 	def flattened(self):
 		"""Return PIL image composed of all layers."""
+		if self._images is None:
+			return Image.merge("RGB", [Image.fromarray(self.flat_cube(c))
+				for c in range(len(self._image_cubes))])
 		return reduce(ImageChops.lighter, self.images)
 
+	def flat_cube(self, channel):
+		"""Return max projection along Z of the images of `channel`."""
+		cube = self._image_cubes[channel]
+		cached = self._flat.get(channel)
+		if cached is None or cached[0] is not cube:
+			cached = self._flat[channel] = cube, cube.max(0)
+		return cached[1]
+
 	def save(self, pattern):
 		"""Save as series of images. In pattern {n} is for image number."""
-		for n, image in enumerate(self.images):
+		images = self._images
+		if images is None: # do not keep them, they are not drawn on
+			images = self._make_images(self._image_cubes)
+		for n, image in enumerate(images):
 			image.save(pattern.format(n=n))
 
 	def assign_cubes(self, force=False):
@@ -507,22 +1271,27 @@ class Images(object):
 		"""Create image stack for three color cubes."""
 		if cubes is not None:
 			self.cubes = self.default_cubes(cubes)
+			self._shared = set()
 		assert all(cube.dtype == "uint8" for cube in self.cubes)
 		assert all(cube.shape == self.cubes[0].shape for cube in self.cubes)
-		im = {}
-		for c, cube in enumerate(self.cubes):
-			for z in range(cube.shape[0]):
-				shape = tuple(reversed(cube[z].shape))[:2]
-				im[c,z] = Image.frombytes("L", shape, cube[z].tostring())
-		self.images = [
-			Image.merge("RGB", (im[0,z], im[1,z], im[2,z]))
-			for z in range(cube.shape[0])
-		]
+		self._images, self._image_cubes = None, list(self.cubes)
 		return self
 
 	def clone(self):
-		"""Create a copy of self."""
-		return Images().from_cubes([cube.copy() for cube in self.cubes])
+		"""Create a copy of self, sharing cubes until changed."""
+		result = Images().from_cubes(self.cubes)
+		result._flat = dict(self._flat)
+		self._shared = set(range(len(self.cubes)))
+		result._shared = set(self._shared)
+		return result
+
+	def writable_cube(self, channel):
+		"""Return cube of `channel` to change in place, copy it if shared."""
+		if channel in self._shared:
+			self.cubes[channel] = self.cubes[channel].copy()
+			self._shared.discard(channel)
+		self._flat.pop(channel, None)
+		return self.cubes[channel]
 
 	@staticmethod
 	def default_cubes(cubes):
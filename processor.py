@@ -3,15 +3,24 @@ import optparse
 import os
 import glob
 import sys
+from multiprocessing import Pool
 import numpy as np
 from scipy.ndimage import gaussian_filter, median_filter, maximum_filter
 from PIL import Image
 from tifffile import tifffile
 
-from analyze import Images, Spots
+from analyze import Images, Spot, Spots, overlaps
 from utils import log, log_dict, logging, ifverbose, roundint, Re, dict_path
+from utils import thread_map, LRU, memoize
 
 options = None
+smart_cells = None # cells and images for worker processes of smart
+slab_filter_min_size = 2 ** 20 # smaller cubes are filtered in one piece
+filter_buffers = 6 # scratch cubes taken at once by Filters, at most
+min_tile_side = 32 # pixels of a tile of filter_tiles, at least
+normalize_chunk_size = 2 ** 24 # pixels of layers normalize_layers sorts at once
+scratch = None # Scratch buffers of Filters
+filter_cache = None # LRU of (sources, cube) of Filters by filter chain
 colors = [(200, 50, 50), (200, 100, 0), (200, 0, 100), (150, 200, 0)]
 option_colors = dict(red=0, green=1, blue=2, red2=0, green2=1, blue2=2)
 draw_colors = ('red2', 'green', 'blue')
@@ -25,6 +34,12 @@ def main():
 
 def start():
 	global images # see XXX in detect_signals
+	global scratch, filter_cache
+	scratch = Scratch()
+	# results of tiled filters would not fit the budget, do not keep them
+	cache_size = 0 if options.filter_memory_budget else options.filter_cache
+	filter_cache = LRU(cache_size * 2 ** 20,
+		weight=lambda (sources, cube): cube.nbytes)
 	for color in sorted(options.color):
 		log_dict(vars(options.color[color]))
 	images = load_images()
@@ -50,6 +65,9 @@ def start():
 	draw_flat_channels(images, "img-colors.png", spotss)
 	draw_3D_colors(images, "img-c{n:02}.png", spotss)
 	print_results(spotss, images)
+	log("Filter scratch peak: {:.1f} MB".format(scratch.peak / 2.0 ** 20))
+	log("Filter cache: {} hits, {} misses, {:.1f} MB held".format(
+		filter_cache.hits, filter_cache.misses, filter_cache.used / 2.0 ** 20))
 
 def process_colors(spotss, images, colors, normalized=None):
 	for color_options in colors:
@@ -77,19 +95,73 @@ def print_results(spotss, images):
 def smart(spotss, images, options):
 	images = detect_cells(spotss, images, options)
 	prefill_spotss(spotss, images)
-	for n, cell in enumerate(spotss[options.cell_color].spots):
-		log("cell", n, "...")
-		for color, color_options in options.color.items():
-			if color == options.cell_color:
-					continue
-			cube = select_cube(images, color_options, cell)
-			spots = smart_color(cube, color_options)
+	cells = spotss[options.cell_color].spots
+	for cell, found in zip(cells, iter_smart_cells(cells, images)):
+		for color, spots in found:
 			spots.cube = cell.spots.cube # do not waste space for each signal,
 			# but keep _something_ in place for geometry (used in drawing)
-			spotss[color_options.color].spots += spots.spots
+			spotss[color].spots += spots.spots
 	smart_draw(spotss, images, options)
 	return images
 
+def iter_smart_cells(cells, images):
+	"""Yield signals found in each of `cells`, using `options.jobs` processes.
+
+	Worker processes are forked with the cubes in place, and send back
+	spots of each cell packed; they are yielded in the order of cells.
+	"""
+	if options.jobs <= 1 or len(cells) <= 1:
+		for n, cell in enumerate(cells):
+			yield smart_cell(n, cell, images)
+		return
+	global smart_cells
+	smart_cells = cells, images
+	pool = Pool(options.jobs)
+	try:
+		for cell, packed in zip(cells, pool.imap(smart_cell_job, range(len(cells)))):
+			yield [(color, unpack_spots(spots, cell, images))
+				for color, spots in packed]
+	finally:
+		pool.terminate()
+		smart_cells = None
+
+def smart_cell(n, cell, images):
+	log("cell", n, "...")
+	found = []
+	for color, color_options in options.color.items():
+		if color == options.cell_color:
+				continue
+		spots = smart_cell_color(images, color_options, cell)
+		found.append((color_options.color, spots))
+	return found
+
+def smart_cell_job(n):
+	cells, images = smart_cells
+	return [(color, pack_spots(spots))
+		for color, spots in smart_cell(n, cells[n], images)]
+
+def pack_spots(spots):
+	packed = []
+	for spot in spots.spots:
+		if spot.box is None:
+			packed.append((tuple(np.asarray(coord) for coord in spot.coords),))
+		else:
+			box = tuple((side.start, side.stop) for side in spot.box)
+			packed.append((box, spot.mask.shape, np.packbits(spot.mask)))
+	return packed
+
+def unpack_spots(packed, cell, images):
+	spots = Spots(cell.spots.cube, images=images)
+	for description in packed:
+		if len(description) == 1:
+			spot = Spot(spots, coords=description[0])
+		else:
+			box, shape, bits = description
+			mask = np.unpackbits(bits)[:np.prod(shape)].reshape(shape).view(bool)
+			spot = Spot(spots, box=tuple(slice(*side) for side in box), mask=mask)
+		spots.spots.append(spot)
+	return spots
+
 def detect_cells(spotss, images, options):
 	log("Detecting cells...")
 	color_options = options.color[options.cell_color]
@@ -112,13 +184,138 @@ def select_cube(images, color_options, cell):
 	cube[cell.coords] = src_cube[cell.coords]
 	return cube
 
-def smart_color(cube, color_options):
-	cube = cube.astype('float')
+def smart_color(cube, color_options, source=None):
+	return detect_signals(smart_filters(cube, color_options, source),
+		color_options)
+
+def smart_filters(cube, color_options, source=None):
+	tiles = filter_tiles(cube.shape, color_options)
+	if tiles is not None:
+		return tiled_filters(cube, color_options, tiles, source)
+	return filter_cube(cube, color_options, source)
+
+def filter_cube(cube, color_options, source=None):
+	cube = float_cube(cube)
 	if color_options.blur:
 		blur, color = color_options.blur, color_options.color
-		cube = Filters(cube, blur, color, False).cube
-	cube = cube.clip(0, 255).astype('uint8')
-	return detect_signals(cube, color_options)
+		cube = Filters(cube, blur, color, False, source).cube
+	return uint8_cube(cube)
+
+def filter_tiles(shape, color_options):
+	"""Return (tile, crop) boxes of XY tiles of `shape` to filter, or None.
+
+	Each crop holds its tile and the halo reached by the blur filters and
+	takes at most options.filter_memory_budget of scratch cubes, unless
+	even tiles of min_tile_side do not fit it. None is for filtering in one
+	piece: no budget, no tiles needed, or filters that depend on whole
+	planes.
+	"""
+	if not options.filter_memory_budget or not color_options.blur:
+		return None
+	radius = FilterReach(color_options.blur).radius
+	if radius is None:
+		return None
+	depth, height, width = shape
+	voxel = filter_buffers * np.dtype(filter_dtype()).itemsize * depth
+	area = options.filter_memory_budget * 2 ** 20 // voxel
+	if area >= height * width:
+		return None
+	side = int(np.sqrt(area)) - 2 * max(radius[1:])
+	if side < min_tile_side:
+		side = min_tile_side
+		log("Warning: {:.1f} MB crops of {} filters exceed filter memory budget".format(
+			voxel * (side + 2 * radius[1]) * (side + 2 * radius[2]) / 2.0 ** 20,
+			color_options.color))
+	tiles = []
+	for y in range(0, height, side):
+		for x in range(0, width, side):
+			tile = (slice(0, depth), slice(y, min(y + side, height)),
+				slice(x, min(x + side, width)))
+			crop = tuple(slice(max(side.start - r, 0), min(side.stop + r, size))
+				for side, r, size in zip(tile, radius, shape))
+			tiles.append((tile, crop))
+	return tiles
+
+def tiled_filters(cube, color_options, tiles, source=None):
+	"""Return smart_filters of `cube`, filtering crops of `tiles` in turn."""
+	result = np.empty(cube.shape, np.uint8)
+	for tile, crop in tiles:
+		start = tuple(side.start for side in crop)
+		part = filter_cube(cube[crop], color_options,
+			source and source + (start,))
+		result[tile] = part[tuple(slice(a.start - b.start, a.stop - b.start)
+			for a, b in zip(tile, crop))]
+	return result
+
+def smart_cell_color(images, color_options, cell):
+	"""Detect signals within `cell` on a crop of the cube around it.
+
+	The crop holds the cell and a halo reached by the blur filters, so
+	the result is the same as of smart_color on the whole masked cube.
+	"""
+	radius = smart_crop_radius(color_options)
+	if radius is None:
+		source = images.cubes[color_options.channel], cell
+		return smart_color(select_cube(images, color_options, cell),
+			color_options, source)
+	src_cube = images.cubes[color_options.channel]
+	grow = lambda box, d: tuple(
+		slice(max(side.start - r, 0), min(side.stop + r, size))
+		for side, r, size in zip(box, d, src_cube.shape))
+	box = cell.bounds()
+	exact = grow(box, radius)
+	crop = grow(box, 2 * channel_crop_radius(color_options) + 1)
+	start = [side.start for side in crop]
+	cube = np.zeros([side.stop - side.start for side in crop], src_cube.dtype)
+	coords = cell.coords
+	cube[tuple(coord - s for coord, s in zip(coords, start))] = src_cube[coords]
+	cube = smart_filters(cube, color_options, (src_cube, cell, tuple(start)))
+	# away from the cell, filtered pixels are filtered zeros, i.e. zeros
+	outside = np.ones(cube.shape, bool)
+	outside[tuple(slice(a.start - s, a.stop - s) for a, s in zip(exact, start))] = 0
+	cube[outside] = 0
+	spots = detect_signals(cube, color_options, src_cube.size - cube.size)
+	for spot in spots.spots:
+		spot.box = tuple(
+			slice(side.start + s, side.stop + s)
+			for side, s in zip(spot.box, start))
+	return spots
+
+def smart_crop_radius(color_options):
+	"""Return Z,Y,X radius of pixels reached by filters, None for no crop."""
+	return crop_radius(color_options.detect, color_options.blur)
+
+@memoize()
+def crop_radius(detect, blur):
+	detectors = [func.split('(')[0].strip() for func in detect.split(';')]
+	if not set(detectors) <= set(['cc', 'tight', 'percentile', 'topvoxels']):
+		return None
+	if not blur:
+		return np.zeros(3, int)
+	radius = FilterReach(blur).radius
+	if radius is None:
+		return None
+	zeros = float_cube(np.zeros((3, 3, 3)))
+	if uint8_cube(Filters(zeros, blur, None, False).cube).any():
+		return None
+	return radius
+
+def channel_crop_radius(color_options):
+	"""Return radius of the crop of a cell for `color_options`.
+
+	With filter_cache, colors of a channel crop cells alike, so that their
+	filter chains on the same cell share results.
+	"""
+	radius = smart_crop_radius(color_options)
+	if not filter_cache.size:
+		return radius
+	for other in options.color.values():
+		if (other.channel == color_options.channel
+				and other.color != options.cell_color):
+			other_radius = smart_crop_radius(other)
+			if other_radius is not None:
+				radius = np.maximum(radius, other_radius)
+	return radius
 
 def smart_draw(spotss, images, options):
 	for color in spotss:
@@ -296,18 +493,108 @@ def tiff_to_czxy(tiff):
 
 @logging
 def despeckle_images(images):
+	channels = []
 	for color_options in options.color.values():
-		channel = color_options.channel
-		cube = images.cubes[channel]
-		if color_options.despeckle:
-			cube = median_filter(cube, (3,1,1))
+		if color_options.despeckle and color_options.channel not in channels:
+			channels.append(color_options.channel)
+	def despeckle(channel, threads=None):
+		cube = images.writable_cube(channel)
+		for color_options in options.color.values():
+			if color_options.channel == channel and color_options.despeckle:
+				cube = median_z(cube, 3, threads)
+		return cube
+	if len(channels) > 1:
+		cubes = thread_map(lambda channel: despeckle(channel, 1), channels,
+			options.threads)
+	else:
+		cubes = map(despeckle, channels)
+	for channel, cube in zip(channels, cubes):
 		images.cubes[channel] = cube
 	return images.from_cubes()
 
+def slab_filter(filter, cube, size, threads=None, output=None):
+	"""Return `filter(cube, size)` computed in slabs on `threads` threads.
+
+	`filter` is one of scipy.ndimage gaussian_filter (`size` is sigma),
+	maximum_filter or median_filter. The cube is split in Z or Y slabs
+	overlapping by the reach of the filter, so the result is the same.
+	The result is written to `output` if given.
+	"""
+	threads = threads or options.threads
+	if filter is median_filter and is_median_z(size):
+		if output is None:
+			output = np.empty_like(cube)
+		output[...] = cube
+		return median_z(output, size[0], threads)
+	if threads <= 1 or cube.size < slab_filter_min_size:
+		return filter(cube, size, output=output)
+	if filter is gaussian_filter:
+		radius = FilterReach.gauss_radius(size)
+	else:
+		radius = FilterReach.sides_radius(np.broadcast_to(size, 3))
+	axis = 0 if cube.shape[0] >= cube.shape[1] else 1
+	length, reach = cube.shape[axis], radius[axis]
+	bounds = np.linspace(0, length, threads + 1).astype(int)
+	slab = lambda start, stop: (slice(None),) * axis + (slice(start, stop),)
+	def run(bounds):
+		start, stop = bounds
+		low, high = max(start - reach, 0), min(stop + reach, length)
+		result = filter(cube[slab(low, high)], size)
+		return result[slab(start - low, stop - low)]
+	slabs = [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+	return np.concatenate(thread_map(run, slabs, threads), axis, out=output)
+
+def is_median_z(size):
+	return (not np.isscalar(size) and len(size) == 3
+		and tuple(size[1:]) == (1, 1) and size[0] % 2 == 1)
+
+def median_z(cube, size=3, threads=None):
+	"""Filter `cube` in place as `median_filter(cube, (size, 1, 1))`.
+
+	`size` is small and odd. The median of 3 planes is taken with min and
+	max, of more planes by partial sort. Y slabs are filtered plane by
+	plane on `threads` threads, keeping copies of the source planes in
+	the window only.
+	"""
+	threads = threads or options.threads
+	if cube.size < slab_filter_min_size:
+		threads = 1
+	depth, height = cube.shape[:2]
+	reach = size // 2
+	def index(z): # mode='reflect' of scipy.ndimage
+		z %= 2 * depth
+		return z if z < depth else 2 * depth - 1 - z
+	def run(bounds):
+		start, stop = bounds
+		slab = cube[:, start:stop]
+		planes = {}
+		if size == 3:
+			low, high = np.empty_like(slab[0]), np.empty_like(slab[0])
+		for z in range(depth):
+			window = [index(z + d) for d in range(-reach, reach + 1)]
+			for w in window:
+				if w not in planes:
+					planes[w] = slab[w].copy()
+			for w in [w for w in planes if w < z - reach]:
+				del planes[w]
+			if size == 3:
+				a, b, c = [planes[w] for w in window]
+				np.minimum(a, b, out=low)
+				np.maximum(a, b, out=high)
+				np.minimum(high, c, out=high)
+				np.maximum(low, high, out=slab[z])
+			else:
+				stack = np.array([planes[w] for w in window])
+				slab[z] = np.partition(stack, reach, axis=0)[reach]
+	bounds = np.linspace(0, height, threads + 1).astype(int)
+	slabs = [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+	thread_map(run, slabs, threads)
+	return cube
+
 @logging
-def detect_signals(cube, options):
+def detect_signals(cube, options, hidden_zeros=0):
 	global images # XXX: the code is too messy to get images any other way
-	spots = Detectors(cube, options, images).spots
+	spots = Detectors(cube, options, images, hidden_zeros).spots
 	if options.min_size and options.max_size:
 		spots.filter_by_size(options.min_size, options.max_size)
 	if options.mass_percentile and (options.min_mass or options.max_mass):
@@ -316,8 +603,9 @@ def detect_signals(cube, options):
 	return spots
 
 class Detectors(object):
-	def __init__(self, cube, options, images):
+	def __init__(self, cube, options, images, hidden_zeros=0):
 		self.spots = Spots(cube, images=images)
+		self.spots.hidden_zeros = hidden_zeros
 		self.options = options
 		for func in options.detect.split(';'):
 			eval('self.' + func)
@@ -330,12 +618,11 @@ class Detectors(object):
 		self.spots.detect_cc(level)
 
 	def percentile(self, percentile):
-		level = np.percentile(self.spots.cube, percentile)
+		level = self.spots.percentile_level(percentile)
 		self.spots.detect_cc(level)
 
 	def topvoxels(self, voxels):
-		where = self.spots.cube.argpartition(-voxels, axis=None)[-voxels]
-		level = self.spots.cube.flat[where]
+		level = self.spots.top_level(voxels)
 		self.spots.detect_cc(level)
 
 	def spheres(self, n, radius, wipe_radius=None):
@@ -344,79 +631,291 @@ class Detectors(object):
 	def cylinders(self, n, radius, wipe_radius=None):
 		self.spots.detect_cylinders(n, radius, wipe_radius or radius)
 
+class Scratch(object):
+	"""Pool of flat buffers reused for filtered cubes across calls and cells.
+
+	`take` returns a cube viewing the smallest free buffer that fits, or
+	a new one; `give` returns the buffer of a cube to the pool. `peak` is
+	the largest number of bytes taken at once.
+	"""
+
+	def __init__(self, keep=4):
+		self.keep = keep
+		self.free = []
+		self.used = self.peak = 0
+
+	def take(self, shape, dtype):
+		dtype, size = np.dtype(dtype), int(np.prod(shape))
+		fits = [buffer for buffer in self.free
+			if buffer.dtype == dtype and buffer.size >= size]
+		if fits:
+			buffer = min(fits, key=lambda buffer: buffer.size)
+			self.free = [other for other in self.free if other is not buffer]
+		else:
+			buffer = np.empty(size, dtype)
+		self.used += buffer.nbytes
+		self.peak = max(self.peak, self.used)
+		return buffer[:size].reshape(shape)
+
+	def give(self, cube):
+		if not cube.flags.writeable: # cached in filter_cache
+			return
+		buffer = cube if cube.base is None else cube.base
+		if any(other is buffer for other in self.free):
+			return
+		self.used -= buffer.nbytes
+		self.free.append(buffer)
+		if len(self.free) > self.keep:
+			self.free.sort(key=lambda buffer: buffer.nbytes)
+			del self.free[0]
+
+def filter_dtype():
+	return np.float32 if options.low_memory else np.float64
+
+def float_cube(cube):
+	"""Return a copy of `cube` in a scratch buffer of the filter dtype."""
+	result = scratch.take(cube.shape, filter_dtype())
+	result[...] = cube
+	return result
+
+def uint8_cube(cube):
+	"""Return scratch `cube` clipped to 0..255 as uint8; give `cube` back."""
+	if not cube.flags.writeable: # cached in filter_cache
+		return np.clip(cube, 0, 255).astype('uint8')
+	result = np.clip(cube, 0, 255, out=cube).astype('uint8')
+	scratch.give(cube)
+	return result
+
 class Filters(object):
+	"""Filter chain on a scratch `cube`, see float_cube.
 
-	def __init__(self, cube, string, color, draw=True):
-		self.cube = self.src_cube = cube
+	The filters own `cube`: it and the intermediate cubes are given back
+	to scratch as soon as they are not needed, except the resulting cube.
+
+	If `source` is given, the ndimage filter results are kept read-only
+	in filter_cache and shared by filter chains with the same prefix.
+	`source` is a tuple of objects (compared by identity) and tuples
+	(compared by value) that determine `cube`.
+	"""
+
+	def __init__(self, cube, string, color, draw=True, source=None):
+		self.cube = cube
 		self.cubes = None
 		self.color = color
 		self.draw = draw
+		self.sources = self.key = None
+		if source is not None and filter_cache.size:
+			self.sources = tuple(item for item in source
+				if not isinstance(item, tuple))
+			self.key = (cube.shape, cube.dtype.str) + tuple(
+				item if isinstance(item, tuple) else id(item)
+				for item in source)
 		for func in string.split(';'):
+			self.keys = {id(self.cube): self.key}
 			eval('self.' + func)
+			if self.key is not None:
+				self.key += (func.strip(),)
 		if draw:
 			draw_flat_cubes(self.cubes or [self.cube] * 3,
 				'blur-{}-all.png'.format(self.color))
 			#draw_3D_cubes((cube, blur_cube, max_cube),
 			#	'blur-%s-{n:02}.png' % self.color)
+		for cube in self.cubes or []:
+			if cube is not self.cube:
+				scratch.give(cube)
+
+	def take(self):
+		return scratch.take(self.cube.shape, self.cube.dtype)
+
+	def give(self, *cubes):
+		for cube in cubes:
+			if not any(cube is other for other in self.cubes or []):
+				scratch.give(cube)
+
+	def replace(self, cube):
+		self.give(self.cube)
+		self.cube = cube
+
+	def filter(self, filter, cube, size):
+		"""Return `filter(cube, size)`; it is read-only if cached."""
+		key = self.keys.get(id(cube))
+		if key is None:
+			return slab_filter(filter, cube, size, output=self.take())
+		key += ((filter.__name__, size),)
+		def compute():
+			result = slab_filter(filter, cube, size)
+			result.flags.writeable = False
+			return self.sources, result
+		result = filter_cache.get(key, compute)[1]
+		self.keys[id(result)] = key
+		return result
 
 	def peak(self, sigma, side=3):
 		if isinstance(side, int):
 			side = (side, side * 3, side * 3)
-		blur_cube = gaussian_filter(self.cube, sigma)
-		max_cube = maximum_filter(blur_cube, side)
-		self.cube = (self.cube - blur_cube) * 100 / max_cube
+		blur_cube = self.filter(gaussian_filter, self.cube, sigma)
+		max_cube = self.filter(maximum_filter, blur_cube, side)
+		cube = np.subtract(self.cube, blur_cube, out=self.take())
+		cube *= 100
+		cube /= max_cube
+		self.replace(cube)
 		self.cubes = [self.cube, blur_cube, max_cube]
 
 	def peak1(self, sigma=2, sides=(1,99,99)):
-		no_peaks = gaussian_filter(self.cube, sigma)
-		background = maximum_filter(no_peaks, sides)
-		self.cube = self.cube / (background + 1) * 100
+		no_peaks = self.filter(gaussian_filter, self.cube, sigma)
+		background = self.filter(maximum_filter, no_peaks, sides)
+		cube = np.add(background, 1, out=self.take())
+		np.divide(self.cube, cube, out=cube)
+		cube *= 100
+		self.give(no_peaks, background)
+		self.replace(cube)
 
 	def peak2(self, sigma=2, sides1=(1,11,11), sides2=(3,99,99)):
-		no_peaks = gaussian_filter(self.cube, sigma)
-		background1 = maximum_filter(no_peaks, sides1)
-		background2 = maximum_filter(no_peaks, sides2)
-		cube1 = self.cube / (background1 + 1)
-		cube2 = self.cube / (background2 + 1)
-		self.cube = cube1 * cube2 * 100
+		no_peaks = self.filter(gaussian_filter, self.cube, sigma)
+		background1 = self.filter(maximum_filter, no_peaks, sides1)
+		background2 = self.filter(maximum_filter, no_peaks, sides2)
+		self.give(no_peaks)
+		cube1 = np.add(background1, 1, out=self.take())
+		np.divide(self.cube, cube1, out=cube1)
+		self.give(background1)
+		cube2 = np.add(background2, 1, out=self.take())
+		np.divide(self.cube, cube2, out=cube2)
+		self.give(background2)
+		cube1 *= cube2
+		cube1 *= 100
+		self.give(cube2)
+		self.replace(cube1)
 
 	def peak3(self, sigma=2, sides=(1,99,99), w_near=1, w_far=1):
-		no_peaks = gaussian_filter(self.cube, sigma)
-		background = maximum_filter(no_peaks, sides)
-		cube1 = self.cube / no_peaks
-		cube2 = no_peaks / background
-		self.cube = (cube1 ** 2 * w_near + cube2 ** 2 * w_far) / (w_near + w_far) * 100
+		no_peaks = self.filter(gaussian_filter, self.cube, sigma)
+		background = self.filter(maximum_filter, no_peaks, sides)
+		cube1 = np.divide(self.cube, no_peaks, out=self.take())
+		cube2 = np.divide(no_peaks, background, out=self.take())
+		self.give(no_peaks, background)
+		np.square(cube1, out=cube1)
+		cube1 *= w_near
+		np.square(cube2, out=cube2)
+		cube2 *= w_far
+		cube1 += cube2
+		cube1 /= w_near + w_far
+		cube1 *= 100
+		self.give(cube2)
+		self.replace(cube1)
 
 	def gauss(self, sigma):
-		self.cube = gaussian_filter(self.cube, sigma)
+		self.replace(self.filter(gaussian_filter, self.cube, sigma))
 
 	def max(self, dx, dy=None, dz=None):
 		if dy is None or dz is None:
 			dx, dy, dz = dx * 3, dx * 3, dx
-		self.cube = maximum_filter(self.cube, (dz, dy, dx))
+		self.replace(self.filter(maximum_filter, self.cube, (dz, dy, dx)))
 
 	def median(self, dx, dy=None, dz=None):
 		if dy is None or dz is None:
 			dx, dy, dz = dx * 3, dx * 3, dx
-		self.cube = median_filter(self.cube, (dz, dy, dx))
+		self.replace(self.filter(median_filter, self.cube, (dz, dy, dx)))
 
-	def normalize_layers(self, quantile=0.7):
+	def normalize_layers(self, quantile=0.7, subsample=1):
 		# scale & shift to make 0.7 quantile value at 0.7 brightness, max at 1
 		# this potentially resets some very dark pixels to 0 (any fuss?)
-		for z in range(self.cube.shape[0]):
-			low = np.percentile(self.cube[z], quantile)
-			high = self.cube[z].max()
-			scale = (1 - quantile) / (high - low)
-			shift = 1 - scale * high
-			self.cube[z] = self.cube[z] * scale + shift
+		# the quantile is of each `subsample`-th pixel of a layer
+		if not self.cube.flags.writeable: # cached in filter_cache
+			cube = self.take()
+			cube[...] = self.cube
+			self.replace(cube)
+		depth = self.cube.shape[0]
+		layers = self.cube.reshape(depth, -1)
+		lows, highs = [], []
+		step = max(normalize_chunk_size // layers.shape[1], 1)
+		for z in range(0, depth, step):
+			chunk = layers[z:z + step]
+			lows.append(row_percentiles(chunk[:, ::subsample], quantile))
+			highs.append(chunk.max(axis=1))
+		lows, highs = np.concatenate(lows), np.concatenate(highs)
+		scale = (1 - quantile) / (highs - lows)
+		shift = 1 - scale * highs
+		layers *= scale.astype(self.cube.dtype)[:, np.newaxis]
+		layers += shift.astype(self.cube.dtype)[:, np.newaxis]
+
+def row_percentiles(rows, q):
+	"""Return q-th percentile of each row, as np.percentile(rows, q, axis=1).
+
+	Unlike np.percentile, this does not look for NaN values (they sort last).
+	"""
+	index = q / 100.0 * (rows.shape[1] - 1)
+	below = int(np.floor(index))
+	above = min(below + 1, rows.shape[1] - 1)
+	weight = index - below
+	rows = np.partition(rows, sorted(set([below, above])), axis=1)
+	low, high = rows[:, below].astype(float), rows[:, above].astype(float)
+	return low * (1.0 - weight) + high * weight
+
+class FilterReach(object):
+	"""Z,Y,X radius of the neighborhood Filters read to find a pixel.
+
+	The methods follow Filters. The radius is None when the filters
+	depend on whole planes of the cube.
+	"""
+
+	def __init__(self, string):
+		self.radius = np.zeros(3, int)
+		for func in string.split(';'):
+			eval('self.' + func)
+
+	def add(self, radius):
+		if self.radius is not None:
+			self.radius = self.radius + radius
+
+	@staticmethod
+	def gauss_radius(sigma):
+		# as in gaussian_filter with default truncate=4.0
+		return (4.0 * np.broadcast_to(sigma, 3) + 0.5).astype(int)
+
+	@staticmethod
+	def sides_radius(sides):
+		return np.array(sides, int) // 2
+
+	def peak(self, sigma, side=3):
+		if isinstance(side, int):
+			side = (side, side * 3, side * 3)
+		self.add(self.gauss_radius(sigma) + self.sides_radius(side))
+
+	def peak1(self, sigma=2, sides=(1,99,99)):
+		self.add(self.gauss_radius(sigma) + self.sides_radius(sides))
+
+	def peak2(self, sigma=2, sides1=(1,11,11), sides2=(3,99,99)):
+		sides = np.maximum(self.sides_radius(sides1), self.sides_radius(sides2))
+		self.add(self.gauss_radius(sigma) + sides)
+
+	def peak3(self, sigma=2, sides=(1,99,99), w_near=1, w_far=1):
+		self.add(self.gauss_radius(sigma) + self.sides_radius(sides))
+
+	def gauss(self, sigma):
+		self.add(self.gauss_radius(sigma))
+
+	def max(self, dx, dy=None, dz=None):
+		if dy is None or dz is None:
+			dx, dy, dz = dx * 3, dx * 3, dx
+		self.add(self.sides_radius((dz, dy, dx)))
+
+	def median(self, dx, dy=None, dz=None):
+		self.max(dx, dy, dz)
+
+	def normalize_layers(self, quantile=0.7, subsample=1):
+		self.radius = None
 
 @logging
 def detection_filters(images, options):
-	cube = images.cubes[options.channel].astype('float')
+	src_cube = images.cubes[options.channel]
+	if filter_tiles(src_cube.shape, options) is not None:
+		cube = smart_filters(src_cube, options, (src_cube,))
+		draw_flat_cube(cube, 'blur-{}.png'.format(options.color))
+		return cube
+	cube = float_cube(src_cube)
 	if options.blur:
-		cube = Filters(cube, options.blur, options.color).cube
+		cube = Filters(cube, options.blur, options.color, True, (src_cube,)).cube
 		draw_flat_cube(cube, 'blur-{}.png'.format(options.color))
-	return cube.clip(0, 255).astype('uint8')
+	return uint8_cube(cube)
 
 @logging
 def build_neighborhoods(spots, images):
@@ -481,9 +980,9 @@ def print_scale(images):
 @logging
 def print_signals(spotss):
 	print "cell_n", "color", "spot", "x", "y", "z", "size", "volume"
-	for cell_n, cell in iter_cells(spotss):
+	for cell_n, cell, members in iter_cells(spotss):
 		print_signal_stats(cell_n, options.cell_color, cell_n, cell)
-		for color, spot_n, spot in iter_cell_spots(spotss, cell):
+		for color, spot_n, spot in members:
 			print_signal_stats(cell_n, color, spot_n, spot)
 
 def print_signal_stats(cell_n, color, spot_n, spot):
@@ -498,17 +997,40 @@ def print_pairs(spotss):
 	print "cell_n", "color1", "spot1", "color2", "spot2",
 	print "distance", "physical_distance", "ellipsoid_distance",
 	print "overlap", "overlap_volume"
-	for cell_n, cell in iter_cells(spotss):
+	row = "{} {} {} {} {} {:.2f} {:.2f} {:.2f} {:.2f} {:.2f}\n"
+	rows = []
+	for cell_n, cell, members in iter_cells(spotss):
 		log("cell", cell_n, "...")
-		for color1, spot_n1, spot1 in iter_cell_spots(spotss, cell):
-			for color2, spot_n2, spot2 in iter_cell_spots(spotss, cell):
+		if not members:
+			continue
+		spots = [spot for color, spot_n, spot in members]
+		distances, physical_distances = cell_distances(spots)
+		overlaps = cell_overlaps(spots)
+		volumes = overlaps * voxel_volumes(spots)[:, np.newaxis]
+		ellipsoid_distances = {}
+		for n1, (color1, spot_n1, spot1) in enumerate(members):
+			for n2, (color2, spot_n2, spot2) in enumerate(members):
 				if spot1 == spot2:
 					continue
-				print cell_n, color1, spot_n1, color2, spot_n2,
-				print " ".join("{:.2f}".format(value) for value in [
-					spot1.distance(spot2), spot1.physical_distance(spot2),
-					ellipsoid_distance(spot1, color2, spotss[color2]),
-				] + list(overlap(spot1, spot2)))
+				if (n1, color2) not in ellipsoid_distances:
+					ellipsoid_distances[n1, color2] = ellipsoid_distance(
+						spot1, color2, spotss[color2])
+				rows.append(row.format(cell_n, color1, spot_n1, color2, spot_n2,
+					distances[n1, n2], physical_distances[n1, n2],
+					ellipsoid_distances[n1, color2],
+					overlaps[n1, n2], volumes[n1, n2]))
+	sys.stdout.write("".join(rows))
+
+def cell_distances(spots):
+	centers = np.array([spot.center_of_mass() for spot in spots])
+	scales = np.array([spot.spots.images.scale for spot in spots], dtype=float)
+	pairwise = lambda points: np.linalg.norm(
+		points[:, np.newaxis] - points[np.newaxis], axis=-1)
+	return pairwise(centers), pairwise(centers * scales)
+
+def voxel_volumes(spots):
+	sz, sy, sx = np.array([spot.spots.images.scale for spot in spots]).T
+	return sx * sy * sz
 
 def ellipsoid_distance(spot1, color2, spots2):
 	if color2 not in onion_colors:
@@ -534,24 +1056,20 @@ def onion_distance(spot1, color1, spots2):
 	onion_distance *= spot1.spots.images.scale[-1]
 	return onion_distance
 
-def overlap(spot1, spot2):
-	spots = Spots(spot2.spots.cube)
-	spots.spots = [spot2]
-	overlap = spot1.intersection_occupancy(spots)
-	physical_overlap = spot1.to_physical_volume(overlap)
-	return overlap, physical_overlap
+def cell_overlaps(spots):
+	return overlaps(spots, spots[0].spots.cube.shape)
 
 def iter_cells(spotss):
-	for cell_n, cell in enumerate(spotss[options.cell_color].spots):
-			yield cell_n, cell
-
-def iter_cell_spots(spotss, cell):
+	cells = spotss[options.cell_color]
+	memberss = [[] for cell in cells.spots]
 	for color in spotss:
 		if color == options.cell_color:
 			continue
 		spots = spotss[color]
-		for spot_n in cell.intersection_ids(spots):
-			yield color, spot_n, spots.spots[spot_n]
+		for members, ids in zip(memberss, spots.intersection_ids(cells.spots)):
+			members += [(color, spot_n, spots.spots[spot_n]) for spot_n in ids]
+	for cell_n, (cell, members) in enumerate(zip(cells.spots, memberss)):
+			yield cell_n, cell, members
 
 @with_output
 @logging
@@ -560,14 +1078,16 @@ def print_stats(spotss, images):
 		print ""
 		print color1, color2, size
 		print "spot", "x", "y", "z", "size", "occupancy"
+		occupancies = other.intersection_occupancy(spots.spots)
 		for n, spot in enumerate(spots.spots):
 			z, y, x = ('{:.2f}'.format(coord) for coord in spot.center())
-			print n, x, y, z, spot.size(), spot.intersection_occupancy(other)
+			print n, x, y, z, spot.size(), occupancies[n]
 
 def iter_views(spotss):
 	for color in spotss:
-		for size in options.spot_sizes:
-			espots = Spots(spotss[color]).expanded((0, size, size))
+		sizes = [(0, size, size) for size in options.spot_sizes]
+		expanded = Spots(spotss[color]).expanded_series(sizes)
+		for size, espots in zip(options.spot_sizes, expanded):
 			for other_color in spotss:
 				if other_color != color:
 					other = spotss[other_color]
@@ -583,8 +1103,8 @@ def print_spots(spotss):
 			print
 			print color, other, "intersected-ids"
 			other_spots = spotss[other]
-			for n, spot in enumerate(spotss[color].spots):
-				ids = spot.intersection_ids(other_spots)
+			idss = other_spots.intersection_ids(spotss[color].spots)
+			for n, ids in enumerate(idss):
 				print n, " ".join(map(str, ids))
 
 @with_output
@@ -618,10 +1138,11 @@ def draw_flat_images(images, filename):
 @logging
 def draw_flat_spots(images, filename, spots, options, blackout=True):
 	images = images.clone()
+	cube = images.writable_cube(options.channel)
 	if blackout:
-		images.cubes[options.channel] *= 0
+		cube *= 0
 	for spot in spots.spots:
-		images.cubes[options.channel][spot.coords] = 255
+		cube[spot.coords] = 255
 	images.from_cubes()
 	images.flattened().save(filename.format(**vars(options)))
 
@@ -684,7 +1205,8 @@ def spots_by_channels(images, spotss):
 		color_options = options.color[name]
 		for spot in spotss[name].spots:
 			if name in draw_colors:
-				images.cubes[color_options.channel][spot.coords] = 255
+				cube = images.writable_cube(color_options.channel)
+				cube[spot.coords] = 255
 	return images.from_cubes()
 
 # --------------------------------------------------
@@ -746,6 +1268,19 @@ def option_parser():
 		help="Comma-separated list of spot extension sizes to report occupancy on")
 	p.add_option("--border-color", default=(255, 160, 80),
 		help="Color for border, given as r,g,b values in range 0 to 255")
+	p.add_option("--jobs", default=1, type=int,
+		help="Number of processes detecting signals in cells")
+	p.add_option("--threads", default=1, type=int,
+		help="Number of threads running image filters")
+	p.add_option("--low-memory", action="store_true",
+		help="Filter images as float32 instead of float64")
+	p.add_option("--filter-cache", default=0, type=int,
+		help="Megabytes of filter results to share between colors of a "
+			"channel, 0 for none; held by each job besides filter buffers")
+	p.add_option("--filter-memory-budget", default=0, type=int,
+		help="Megabytes of float filter buffers: filter big images in XY "
+			"tiles to fit, without --filter-cache; images are still loaded "
+			"and detected whole")
 	p.add_option("--verbose", action="store_true",
 		help="Be more verbose: produce more logging & write images")
 
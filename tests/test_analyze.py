@@ -0,0 +1,403 @@
+import unittest
+import warnings
+import numpy as np
+from scipy.ndimage import uniform_filter, morphology
+import analyze
+from analyze import epsilon, Histogram, Spots, Spot, Ellipsoid, Cylinder
+from utils import xyzrange, xyzvrange, find_components
+
+def random_cube(shape=(6, 20, 30), seed=0):
+	return (np.random.RandomState(seed).rand(*shape) * 255).astype('uint8')
+
+def blobs_cube(shape=(6, 20, 30), seed=0):
+	"""Return cube of smoothed noise, with blobs above level 128."""
+	noise = np.random.RandomState(seed).rand(*shape)
+	cube = uniform_filter(noise, 3)
+	cube = (cube - cube.min()) / (cube.max() - cube.min())
+	return (cube * 255).astype('uint8')
+
+def pixel_sets(spots):
+	return sorted(sorted(zip(*[np.asarray(c).tolist() for c in spot.coords]))
+		for spot in spots.spots)
+
+def old_detect_cc(cube, level):
+	"""Detect connected components like the graph search of old."""
+	pixels = set(zip(*(cube > level).nonzero()))
+	edges = {}
+	for pixel in pixels:
+		for other in xyzvrange(pixel):
+			if other in pixels:
+				edges.setdefault(pixel, []).append(other)
+	return sorted(sorted(component) for component in find_components(edges))
+
+def old_expanded(spot, d):
+	"""Return pixels of `spot` expanded by `d` like the pixel loop of old."""
+	Z, Y, X = spot.spots.cube.shape
+	coords = set(zip(*[np.asarray(c).tolist() for c in spot.coords]))
+	for coord in set(coords):
+		coords |= set(xyzrange(coord, d))
+	return sorted((z, y, x) for z, y, x in coords
+		if 0 <= z < Z and 0 <= y < Y and 0 <= x < X)
+
+def old_labels(spots):
+	"""Return cube of spot ids like the spots_cube of old."""
+	cube = np.zeros(spots.cube.shape, dtype='uint16')
+	cube.fill(len(spots.spots) + 1)
+	for n, spot in enumerate(spots.spots):
+		cube[tuple(np.asarray(c).astype(int) for c in spot.coords)] = n
+	return cube
+
+def old_distance_to_variety(spot, spots, max_distance, d):
+	labels = old_labels(spots)
+	for n in range(max_distance):
+		if len(set(labels[tuple(spot.coords)])) != 1:
+			return n
+		spot = spot.expanded(d)
+
+def old_ellipsoid(shape, navel, radii):
+	"""Return coordinates of an ellipsoid like Ellipsoid of old."""
+	radii = tuple(max(v, 1.5) for v in radii)
+	z, y, x = [np.linspace(-1, 1, num=int(2*radius)) for radius in radii]
+	x = x[np.newaxis, np.newaxis, :]
+	y = y[np.newaxis, :, np.newaxis]
+	z = z[:, np.newaxis, np.newaxis]
+	coords = np.array(np.where(x ** 2 + y ** 2 + z ** 2 <= 1))
+	column = lambda v: np.array(v, dtype='int').reshape((3, 1))
+	coords = coords - column(radii) + column(navel)
+	return tuple(coords[axis].clip(0, size - 1)
+		for axis, size in enumerate(shape))
+
+def old_cylinder(shape, navel, radii):
+	"""Return coordinates of a cylinder like Cylinder of old."""
+	radii = tuple(max(v, 1.5) for v in radii)
+	x = np.linspace(-1, 1, num=int(2*radii[-2]))
+	y = np.linspace(-1, 1, num=int(2*radii[-1]))[:, np.newaxis]
+	z = np.zeros(shape=(shape[0], 1, 1))
+	coords = np.array(np.where(x ** 2 + y ** 2 + z ** 2 <= 1))
+	column = lambda v: np.array(v, dtype='int').reshape((3, 1))
+	coords = coords - column((0,) + radii[-2:]) + column((0,) + tuple(navel[-2:]))
+	return tuple(coords[axis].clip(0, size - 1)
+		for axis, size in enumerate(shape))
+
+def pixel_list(coords):
+	return sorted(zip(*[np.asarray(c).tolist() for c in coords]))
+
+def old_center_to_variety(spot, spots, max_distance, d):
+	if not isinstance(d, tuple):
+		d = d, d, d
+	labels = old_labels(spots)
+	center = spot.center_of_mass()
+	for n in range(max_distance):
+		coords = old_ellipsoid(spots.cube.shape, center, (np.array(d)*n).astype('int'))
+		if len(set(labels[coords])) != 1:
+			return n
+
+def old_normalized_cube(spots, quantile, level):
+	"""Return normalized cube like the spot loop of old."""
+	result = np.zeros(spots.cube.shape, dtype='int16')
+	for spot in spots.spots:
+		offset = level - spot.quantile(quantile)
+		res = spots.cube[tuple(spot.coords)].astype('int16') + offset
+		res = (res * ((res >= level) * 0.5 + 0.5)).astype('int16')
+		result[tuple(spot.coords)] = res
+	return result.clip(0, 255).astype('uint8')
+
+def old_stretched_cube(spots, quantile1, quantile2):
+	"""Return stretched cube like the spot loop of old."""
+	result = np.zeros(spots.cube.shape)
+	for spot in spots.spots:
+		low, high = spot.quantile(quantile1), spot.quantile(1.0 - quantile2)
+		frag = spots.cube[tuple(spot.coords)].astype('float64')
+		with np.errstate(divide='ignore', invalid='ignore'):
+			result[tuple(spot.coords)] = (frag - low) * 256.0 / (high - low)
+	return result.clip(0, 255).astype('uint8')
+
+def some_spots(seed=0):
+	"""Return spots of blobs, ellipsoids (one clipped) and loose pixels."""
+	spots = Spots(blobs_cube(seed=seed)).detect_cc(150)
+	spots.spots += [
+		Ellipsoid(spots, (3, 10, 15), (1, 3, 4)),
+		Ellipsoid(spots, (0, 1, 28), (2, 3, 3)),
+		Spot(spots, ([0, 5, 5], [19, 0, 0], [0, 29, 29])),
+	]
+	return spots
+
+class HistogramTest(unittest.TestCase):
+	def test_percentile(self):
+		cube = random_cube()
+		for q in (0, 0.7, 12.5, 50, 99.9, 100):
+			self.assertEqual(Histogram(cube).percentile(q), np.percentile(cube, q))
+
+	def test_percentile_with_zeros(self):
+		cube = random_cube()
+		padded = np.concatenate([cube.ravel(), np.zeros(1000, 'uint8')])
+		for q in (0.7, 50, 90):
+			self.assertEqual(Histogram(cube, zeros=1000).percentile(q),
+				np.percentile(padded, q))
+
+	def test_top(self):
+		cube = random_cube()
+		for k in (1, 10, 200):
+			where = cube.argpartition(-k, axis=None)[-k]
+			self.assertEqual(Histogram(cube).top(k), cube.flat[where])
+
+class ComponentsTest(unittest.TestCase):
+	def test_detect_cc(self):
+		for seed in range(3):
+			cube = blobs_cube(seed=seed)
+			for level in (120, 150, 170):
+				spots = Spots(cube).detect_cc(level)
+				self.assertEqual(pixel_sets(spots), old_detect_cc(cube, level))
+
+	def test_isolated_pixels(self):
+		cube = np.zeros((3, 5, 5), 'uint8')
+		cube[1, 1, 1] = cube[1, 3, 3] = cube[1, 3, 4] = 200
+		spots = Spots(cube).detect_cc(100)
+		self.assertEqual(pixel_sets(spots), [[(1, 3, 3), (1, 3, 4)]])
+
+	def test_raster_order(self):
+		"""Spot ids follow the first pixels of spots in Z,Y,X raster order."""
+		cube = np.zeros((3, 5, 6), 'uint8')
+		cube[2, 0, 0:2] = cube[0, 4, 4:6] = cube[0:2, 1, 1] = 200
+		cube[1, 0:2, 4] = cube[0, 3, 0:4] = 200
+		spots = Spots(cube).detect_cc(100)
+		self.assertEqual([pixel_list(spot.coords)[0] for spot in spots.spots],
+			[(0, 1, 1), (0, 3, 0), (0, 4, 4), (1, 0, 4), (2, 0, 0)])
+		for seed in range(3):
+			spots = Spots(blobs_cube(seed=seed)).detect_cc(150)
+			firsts = [pixel_list(spot.coords)[0] for spot in spots.spots]
+			self.assertEqual(firsts, sorted(firsts))
+
+class ExpandedTest(unittest.TestCase):
+	def test_expanded(self):
+		spots = some_spots()
+		for d in (1, 2, (0, 1, 1), (1, 0, 2), (0, 0, 0)):
+			for spot in spots.spots:
+				expanded = sorted(zip(*[c.tolist() for c in spot.expanded(d).coords]))
+				self.assertEqual(expanded, old_expanded(spot, d))
+
+class DistanceTest(unittest.TestCase):
+	def test_distance_to_variety(self):
+		dense = some_spots()
+		sparse = Spots(dense.cube)
+		sparse.spots = dense.spots[-3:]
+		others = Spots(blobs_cube(seed=1)).detect_cc(150)
+		for spots in (dense, sparse):
+			for d in (1, (0, 1, 1), (1, 0, 1), (0, 0, 1), (0, 0, 0), (1, 2, 2)):
+				for max_distance in (3, 20):
+					for spot in others.spots:
+						self.assertEqual(
+							spot.distance_to_variety(spots, max_distance, d),
+							old_distance_to_variety(spot, spots, max_distance, d))
+
+	def test_distance_within_spot(self):
+		spots = some_spots()
+		for spot in spots.spots[:5]:
+			for d in (1, (0, 1, 1)):
+				self.assertEqual(spot.distance_to_variety(spots, 20, d),
+					old_distance_to_variety(spot, spots, 20, d))
+
+	def test_no_warnings(self):
+		spots = some_spots()
+		# warnings already shown are not shown again, unless forgotten
+		vars(morphology).pop('__warningregistry__', None)
+		with warnings.catch_warnings(record=True) as caught:
+			warnings.simplefilter('always')
+			for d in ((1, 1, 1), (0, 1, 1), (0, 0, 1)):
+				spots.distance_cube(d)
+		self.assertEqual(caught, [])
+
+class StencilTest(unittest.TestCase):
+	shape = (6, 20, 30)
+	navels = [(3, 10, 15), (0, 0, 0), (5, 19, 29), (2.7, 1.2, 28.9), (3, 10, -1)]
+	radii = [(0, 1, 1), (1, 3, 4), (2.5, 2, 7.2), (4, 9, 9)]
+
+	def test_ellipsoid(self):
+		spots = Spots(np.zeros(self.shape, 'uint8'))
+		for navel in self.navels:
+			for radii in self.radii:
+				self.assertEqual(
+					pixel_list(Ellipsoid(spots, navel, radii).coords),
+					pixel_list(old_ellipsoid(self.shape, navel, radii)))
+
+	def test_cylinder(self):
+		spots = Spots(np.zeros(self.shape, 'uint8'))
+		for navel in self.navels:
+			for radii in self.radii:
+				cylinder = Cylinder(spots, navel, radii)
+				self.assertEqual(pixel_list(cylinder.coords),
+					pixel_list(old_cylinder(self.shape, navel, radii)))
+				self.assertEqual(cylinder.navel[0], 0)
+				self.assertEqual(cylinder.radii[0], 0)
+
+class EllipsoidDistanceTest(unittest.TestCase):
+	def test_center_to_variety(self):
+		dense = some_spots()
+		sparse = Spots(dense.cube)
+		sparse.spots = dense.spots[-3:]
+		others = Spots(blobs_cube(seed=1)).detect_cc(150)
+		for spots in (dense, sparse):
+			for d in (1, (0, 1, 1), (1, 2, 2), (0.5, 1, 1)):
+				for max_distance in (3, 20):
+					for spot in others.spots + spots.spots[:3]:
+						self.assertEqual(
+							spot.center_to_variety(spots, max_distance, d),
+							old_center_to_variety(spot, spots, max_distance, d))
+
+	def test_touching_spots(self):
+		cube = np.zeros((5, 10, 20), 'uint8')
+		spots = Spots(cube)
+		spots.spots = [
+			Spot(spots, zip(*np.ndindex(5, 10, 10))),
+			Spot(spots, zip(*[(z, y, x + 10) for z, y, x in np.ndindex(5, 10, 10)])),
+		]
+		for d in (1, (0, 0, 1)):
+			distance = spots.spots[0].center_to_variety(spots, 20, d)
+			self.assertEqual(distance,
+				old_center_to_variety(spots.spots[0], spots, 20, d))
+			self.assertNotEqual(distance, None)
+
+class SpotStatsTest(unittest.TestCase):
+	def check_stats(self, spots):
+		stats = spots.stats()
+		cube = spots.cube
+		for row, spot in enumerate(spots.spots):
+			coords = pixel_list(spot.coords)
+			z, y, x = coords = tuple(np.array(zip(*coords)))
+			values = cube[coords]
+			self.assertEqual(stats.size[row], len(values))
+			self.assertEqual(spot.size(), len(values))
+			self.assertAlmostEqual(spot.mass(), np.sum(values), 3)
+			np.testing.assert_allclose(spot.center(), map(np.mean, coords))
+			np.testing.assert_allclose(spot.center_of_mass(), [
+				np.average(coord, weights=values + epsilon) for coord in coords])
+			self.assertEqual(spot.bounds(), tuple(
+				slice(coord.min(), coord.max() + 1) for coord in coords))
+			np.testing.assert_equal(stats.layers[row],
+				np.bincount(z, minlength=cube.shape[0]))
+
+	def test_stats(self):
+		for seed in range(2):
+			spots = some_spots(seed)
+			spots.spots.append(Cylinder(spots, (0, 1, 2), (0, 3, 3)))
+			spots.stats()
+			self.assertEqual(spots.spots[-1]._coordinates, None)
+			self.check_stats(spots)
+
+	def test_float_cube(self):
+		spots = some_spots()
+		spots.cube = spots.cube.astype('float32') / 7
+		spots.spots.append(Cylinder(spots, (0, 10, 12), (0, 3, 4)))
+		self.check_stats(spots)
+
+class IntersectionTest(unittest.TestCase):
+	def test_intersections(self):
+		spots = some_spots()
+		others = Spots(blobs_cube(seed=1)).detect_cc(150)
+		others.spots.append(Cylinder(others, (0, 10, 15), (0, 4, 4)))
+		labels = old_labels(spots)
+		null = len(spots.spots) + 1
+		for spot in others.spots:
+			ids = labels[tuple(spot.coords)]
+			self.assertEqual(spot.intersection_ids(spots), set(ids) - set([null]))
+			self.assertEqual(spot.intersection_occupancy(spots),
+				np.count_nonzero(ids != null))
+		self.assertEqual(spots.intersection_ids(others.spots),
+			[set(labels[tuple(spot.coords)]) - set([null]) for spot in others.spots])
+
+	def test_chunks(self):
+		spots = some_spots()
+		others = Spots(blobs_cube(seed=1)).detect_cc(150)
+		others.spots.append(Cylinder(others, (0, 10, 15), (0, 40, 40)))
+		labels = old_labels(spots)
+		null = len(spots.spots) + 1
+		expected_ids = [set(labels[tuple(spot.coords)]) - set([null])
+			for spot in others.spots]
+		expected_occupancy = [np.count_nonzero(labels[tuple(spot.coords)] != null)
+			for spot in others.spots]
+		chunk_size = analyze.label_chunk_size
+		try:
+			for size in (1, 50, 2 ** 20):
+				analyze.label_chunk_size = size
+				self.assertEqual(spots.intersection_ids(others.spots), expected_ids)
+				np.testing.assert_equal(spots.intersection_occupancy(others.spots),
+					expected_occupancy)
+		finally:
+			analyze.label_chunk_size = chunk_size
+
+class SpotLabelsTest(unittest.TestCase):
+	def setUp(self):
+		self.coverage = analyze.dense_labels_coverage
+
+	def tearDown(self):
+		analyze.dense_labels_coverage = self.coverage
+
+	def test_cube(self):
+		for coverage in (0, float('inf')):
+			analyze.dense_labels_coverage = coverage
+			for seed in range(2):
+				spots = some_spots(seed)
+				spots.spots.append(Cylinder(spots, (0, 1, 2), (0, 3, 3)))
+				labels = spots.labels()
+				self.assertEqual(labels.dense is None, coverage > 0)
+				self.assertEqual(labels.null, len(spots.spots) + 1)
+				ids = labels.at(np.arange(spots.cube.size))
+				cube = labels.cube()
+				self.assertEqual(spots.spots[-1]._coordinates, None)
+				np.testing.assert_equal(ids, old_labels(spots).ravel())
+				np.testing.assert_equal(cube, old_labels(spots))
+
+	def test_empty(self):
+		for coverage in (0, float('inf')):
+			analyze.dense_labels_coverage = coverage
+			spots = Spots(random_cube())
+			np.testing.assert_equal(spots.labels().cube(), old_labels(spots))
+			np.testing.assert_equal(spots.labels().at([0, 5]), [1, 1])
+
+	def test_changed_spot(self):
+		spots = some_spots()
+		spots.labels()
+		spots.spots[0].coords = spots.spots[1].coords
+		np.testing.assert_equal(spots.spots_cube, old_labels(spots))
+
+class NormalizeTest(unittest.TestCase):
+	def setUp(self):
+		self.coverage = analyze.dense_labels_coverage
+		self.chunk_size = analyze.label_chunk_size
+
+	def tearDown(self):
+		analyze.dense_labels_coverage = self.coverage
+		analyze.label_chunk_size = self.chunk_size
+
+	def test_normalized(self):
+		for spots in self.cases():
+			for quantile, level in ((0.75, 100), (0.2, 30)):
+				np.testing.assert_equal(spots.normalized_cube(quantile, level),
+					old_normalized_cube(spots, quantile, level))
+
+	def test_stretched(self):
+		for spots in self.cases():
+			for quantiles in ((0.2, 0.2), (0.5, 0.1)):
+				np.testing.assert_equal(spots.stretched_cube(*quantiles),
+					old_stretched_cube(spots, *quantiles))
+
+	def test_quantiles(self):
+		for spots in self.cases():
+			expected = [[spot.quantile(q) for q in (0, 0.3, 0.99)]
+				for spot in spots.spots]
+			np.testing.assert_equal(spots.quantiles(0, 0.3, 0.99), expected)
+
+	def cases(self):
+		"""Iterate over overlapping spots, uint8 or float, dense or not."""
+		for coverage, chunk_size in ((0, 2 ** 20), (float('inf'), 50)):
+			analyze.dense_labels_coverage = coverage
+			analyze.label_chunk_size = chunk_size
+			for dtype in ('uint8', 'float32'):
+				spots = some_spots()
+				spots.cube = spots.cube.astype(dtype)
+				spots.spots.append(Cylinder(spots, (0, 10, 12), (0, 3, 4)))
+				spots.spots.append(Spot(spots, ([1], [1], [1])))
+				yield spots
+
+if __name__ == '__main__':
+	unittest.main()
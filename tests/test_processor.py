@@ -0,0 +1,276 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from scipy.ndimage import gaussian_filter, median_filter, maximum_filter
+import processor
+from analyze import Images, Spots, Ellipsoid, Cylinder
+from utils import Struct, LRU
+from tests.test_analyze import random_cube, pixel_list
+
+def make_options(**kwargs):
+	"""Return processor options of the command line defaults and `kwargs`."""
+	options = Struct()
+	vars(options).update(processor.option_parser().defaults)
+	vars(options).update(kwargs)
+	processor.parse_tuple_options(options)
+	processor.split_color_options(options)
+	processor.parse_color_list_options(options)
+	return options
+
+def blobs(shape, n, radius, amplitude, random):
+	cube = np.zeros(shape)
+	for _ in range(n):
+		cube[tuple(random.randint(0, side) for side in shape)] = amplitude
+	sigma = radius / 3.0, radius, radius
+	return gaussian_filter(cube, sigma) * radius ** 2.5
+
+def cell_cubes(shape=(8, 100, 120), seed=1):
+	"""Return red, green, blue cubes of a few cells with signals."""
+	random = np.random.RandomState(seed)
+	noise = lambda level: random.rand(*shape) * level
+	red = blobs(shape, 4, 12, 40, random) + blobs(shape, 30, 2, 1200, random)
+	green = blobs(shape, 30, 1.5, 1500, random)
+	blue = blobs(shape, 30, 1.5, 1500, random)
+	cubes = red + noise(20), green + noise(30), blue + noise(30)
+	return [np.clip(cube, 0, 255).astype('uint8') for cube in cubes]
+
+class SlabsTest(unittest.TestCase):
+	def setUp(self):
+		self.min_size = processor.slab_filter_min_size
+		processor.slab_filter_min_size = 0
+		processor.options = make_options(threads=3)
+
+	def tearDown(self):
+		processor.slab_filter_min_size = self.min_size
+
+	def test_median_z(self):
+		for shape in ((7, 40, 30), (2, 10, 9), (1, 5, 5)):
+			for dtype in ('uint8', 'float32'):
+				cube = random_cube(shape).astype(dtype)
+				for size in (3, 5):
+					for threads in (1, 3):
+						expected = median_filter(cube, (size, 1, 1))
+						result = processor.median_z(cube.copy(), size, threads)
+						np.testing.assert_equal(result, expected)
+
+	def test_slab_filter(self):
+		cube = random_cube((7, 40, 30))
+		tall = random_cube((30, 8, 9))
+		for filter, size in [
+				(gaussian_filter, (1, 2, 2)),
+				(gaussian_filter, 1.5),
+				(maximum_filter, (3, 5, 5)),
+				(median_filter, (3, 3, 3)),
+				(median_filter, (3, 1, 1))]:
+			for source in (cube, tall, cube.astype('float32')):
+				expected = filter(source, size)
+				result = processor.slab_filter(filter, source, size, 3)
+				np.testing.assert_equal(result, expected)
+				output = np.empty_like(source)
+				processor.slab_filter(filter, source, size, 3, output=output)
+				np.testing.assert_equal(output, expected)
+
+	def test_row_percentiles(self):
+		for rows in (random_cube((6, 1, 301))[:, 0], random_cube((5, 1, 2))[:, 0],
+				np.random.RandomState(1).rand(4, 100).astype('float32')):
+			for q in (0, 0.3, 50, 70, 99.9, 100):
+				np.testing.assert_allclose(processor.row_percentiles(rows, q),
+					np.percentile(rows, q, axis=1))
+
+class SmartCellTest(unittest.TestCase):
+	"""Signals detected on a crop of a cell are as of the masked cube."""
+
+	def setUp(self):
+		processor.options = make_options()
+		processor.scratch = processor.Scratch()
+		processor.filter_cache = LRU(0)
+		processor.images = self.images = Images().from_cubes(cell_cubes())
+		cells = Spots(self.images.cubes[0])
+		cells.spots = [
+			Cylinder(cells, (0, 50, 60), (0, 30, 30)),
+			Cylinder(cells, (0, 5, 110), (0, 20, 25)),
+			Ellipsoid(cells, (4, 70, 30), (4, 25, 25)),
+		]
+		self.cells = cells.spots
+
+	def test_detectors(self):
+		for detect in ('cc(100)', 'tight(60, 10)', 'percentile(99.5)',
+				'topvoxels(200)'):
+			for blur in (None, 'gauss(1)', 'peak(1.5, 3)',
+					'peak1(1, (1,9,9));max(1, 2, 1)'):
+				self.check_cells(make_options(green_role='signal',
+					green_detect=detect, green_blur=blur, green_min_size=0,
+					green2_role='signal', green2_blur='peak1(2, (1,15,15))'))
+
+	def check_cells(self, options):
+		processor.options = options
+		color_options = options.color['green']
+		self.assertTrue(processor.smart_crop_radius(color_options) is not None)
+		for cache_size in (0, 2 ** 26):
+			# with the cache, cells are cropped for the wider blur of green2
+			processor.filter_cache = LRU(cache_size)
+			for cell in self.cells:
+				expected = processor.smart_color(processor.select_cube(
+					self.images, color_options, cell), color_options)
+				spots = processor.smart_cell_color(self.images, color_options, cell)
+				self.assertEqual(
+					[pixel_list(spot.coords) for spot in spots.spots],
+					[pixel_list(spot.coords) for spot in expected.spots])
+
+class FilterTilesTest(unittest.TestCase):
+	"""Crops of filter_tiles cover the image and fit the budget."""
+
+	def setUp(self):
+		self.log = processor.log
+		self.logged = []
+		processor.log = lambda *args: self.logged.append(args)
+
+	def tearDown(self):
+		processor.log = self.log
+
+	def tiles(self, shape, budget, blur):
+		processor.options = make_options(filter_memory_budget=budget,
+			green_role='signal', green_blur=blur)
+		return processor.filter_tiles(shape, processor.options.color['green'])
+
+	def test_budget(self):
+		shape = 8, 400, 500
+		voxel = processor.filter_buffers * 8 * shape[0]
+		for budget, blur in ((4, 'peak(1.5, 3)'), (16, 'gauss(1);max(1)'),
+				(8, 'peak1(1, (1,9,9));max(1, 2, 1)')):
+			radius = processor.FilterReach(blur).radius
+			tiles = self.tiles(shape, budget, blur)
+			self.assertTrue(len(tiles) > 1)
+			covered = np.zeros(shape, int)
+			for tile, crop in tiles:
+				covered[tile] += 1
+				self.assertTrue(voxel * np.prod([side.stop - side.start
+					for side in crop[1:]]) <= budget * 2 ** 20)
+				self.assertEqual(crop, tuple(
+					slice(max(side.start - r, 0), min(side.stop + r, size))
+					for side, r, size in zip(tile, radius, shape)))
+			side = tiles[0][0][1].stop
+			self.assertTrue(side > processor.min_tile_side)
+			# square crops of a wider tile would not fit
+			self.assertTrue(voxel * (side + 1 + 2 * max(radius[1:])) ** 2
+				> budget * 2 ** 20)
+			self.assertTrue((covered == 1).all())
+		self.assertEqual(self.logged, [])
+
+	def test_small_budget(self):
+		tiles = self.tiles((8, 400, 500), 1, 'peak1(2, (1,15,15))')
+		self.assertEqual(tiles[0][0][1].stop, processor.min_tile_side)
+		self.assertEqual(len(self.logged), 1)
+		self.assertTrue('exceed' in self.logged[0][0])
+
+	def test_no_tiles(self):
+		self.assertEqual(self.tiles((8, 40, 50), 16, 'gauss(1)'), None)
+		self.assertEqual(self.tiles((8, 400, 500), 0, 'gauss(1)'), None)
+		self.assertEqual(self.tiles((8, 400, 500), 1, 'normalize_layers()'), None)
+
+class RunTest(unittest.TestCase):
+	"""Runs of the whole pipeline give the known good results.
+
+	The outputs in tests/data/run are of serial runs of `run_pipeline`,
+	the same as of the code before the runs got jobs, tiles and the
+	filter cache, up to the raster order of spot ids.
+	"""
+
+	outputs = ('scale.csv', 'signals.csv', 'pairs.csv', 'stats.csv',
+		'spots.csv', 'distances.csv')
+
+	@classmethod
+	def setUpClass(cls):
+		cls.cubes = cell_cubes()
+		cls.golden = cls.known_outputs('default')
+
+	@classmethod
+	def known_outputs(cls, config):
+		"""Return known good outputs of `config` from tests/data/run."""
+		data = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+			'data', 'run', config)
+		return [open(os.path.join(data, name)).read() for name in cls.outputs]
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.tmp = tempfile.mkdtemp()
+		self.load_images = processor.load_images
+		processor.load_images = self.images
+
+	def tearDown(self):
+		processor.load_images = self.load_images
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmp)
+
+	def images(self):
+		images = Images().from_cubes([cube.copy() for cube in self.cubes])
+		images.scale = (300., 80., 80.)
+		images.wavelengths = (600., 500., 400.)
+		return images
+
+	def run_pipeline(self, **kwargs):
+		"""Run the pipeline with options `kwargs`, return outputs."""
+		outdir = os.path.join(self.tmp, str(len(os.listdir(self.tmp))))
+		os.mkdir(outdir)
+		os.chdir(outdir)
+		options = dict(channels='rgb', red_role='territory',
+			red2_role='core', red2_max_size=0, red2_min_size=0,
+			red2_mass_percentile=80, red2_min_mass=0.8, red2_max_mass=1.5,
+			red2_detect='cylinders(n=4, radius=20, wipe_radius=24)',
+			red_blur='peak1(1, (1,9,9));max(1, 2, 1)',
+			green_blur='gauss(1);max(1)', blue_blur='peak(1.5, 3)',
+			**dict(('out_' + name.split('.')[0], name) for name in self.outputs))
+		for color in ('red', 'green', 'blue'):
+			options[color + '_detect'] = 'topvoxels(200)'
+			options.setdefault(color + '_role', 'signal')
+		options.update(kwargs)
+		processor.options = make_options(**options)
+		processor.start()
+		os.chdir(self.cwd)
+		return [open(os.path.join(outdir, name)).read() for name in self.outputs]
+
+	def test_golden(self):
+		for name, output, golden in zip(self.outputs, self.run_pipeline(),
+				self.golden):
+			self.assertEqual(output, golden, name)
+
+	def test_jobs(self):
+		self.assertEqual(self.run_pipeline(jobs=2), self.golden)
+
+	def test_memory_budget(self):
+		serial = self.golden
+		tiled = []
+		tiled_filters = processor.tiled_filters
+		def counted(cube, color_options, tiles, source=None):
+			tiled.append(len(tiles))
+			return tiled_filters(cube, color_options, tiles, source)
+		processor.tiled_filters = counted
+		try:
+			self.assertEqual(self.run_pipeline(filter_memory_budget=1), serial)
+			self.assertEqual(self.run_pipeline(filter_memory_budget=1, threads=2), serial)
+		finally:
+			processor.tiled_filters = tiled_filters
+		self.assertTrue(tiled and max(tiled) > 1)
+
+	def test_filter_cache(self):
+		shared_prefix = dict(green2_role='signal', green2_detect='topvoxels(200)',
+			green_blur='gauss(1)', green2_blur='gauss(1);max(1)')
+		red_red2 = dict(cell_color='blue2', blue2_role='core',
+			blue2_max_size=0, blue2_min_size=0,
+			blue2_detect='cylinders(n=4, radius=20, wipe_radius=24)',
+			red_role='signal', red2_role='signal', red2_detect='topvoxels(200)',
+			red2_min_size=15, red2_max_size=500, red2_mass_percentile=0,
+			red2_blur='peak1(1, (1,9,9))')
+		for name, config in (('shared_prefix', shared_prefix),
+				('red_red2', red_red2)):
+			golden = self.known_outputs(name)
+			self.assertEqual(self.run_pipeline(**config), golden)
+			self.assertEqual(processor.filter_cache.hits, 0)
+			self.assertEqual(self.run_pipeline(filter_cache=64, **config), golden)
+			self.assertTrue(processor.filter_cache.hits > 0)
+			self.assertTrue(processor.filter_cache.used <= 64 * 2 ** 20)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,24 @@
+import unittest
+from utils import LRU
+
+class LRUTest(unittest.TestCase):
+	def test_size(self):
+		cache = LRU(10, weight=len)
+		cache['a'] = 'x' * 4
+		cache['b'] = 'x' * 4
+		cache['a']
+		cache['c'] = 'x' * 4
+		self.assertEqual(sorted(cache.items), ['a', 'c'])
+		self.assertEqual(cache.used, 8)
+
+	def test_heavy_item(self):
+		cache = LRU(10, weight=len)
+		cache['a'] = 'x' * 4
+		self.assertEqual(cache.get('b', lambda: 'x' * 11), 'x' * 11)
+		self.assertEqual(sorted(cache.items), ['a'])
+		self.assertEqual(cache.used, 4)
+		self.assertEqual(LRU(0).get('a', lambda: 1), 1)
+		self.assertEqual(LRU(0).used, 0)
+
+if __name__ == '__main__':
+	unittest.main()
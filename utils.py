@@ -3,7 +3,9 @@ import sys
 import time
 import functools
 import inspect
+from collections import OrderedDict
 from multiprocessing import Process
+from multiprocessing.pool import ThreadPool
 
 def log(*args):
 	args = (time.strftime("[%F %T]"),) + args
@@ -44,6 +46,27 @@ def with_fork(function):
 		process.join()
 	return result
 
+def thread_map(function, items, threads):
+	"""Return list of `function` results for `items`, run on `threads` threads."""
+	if threads <= 1 or len(items) <= 1:
+		return map(function, items)
+	pool = ThreadPool(min(threads, len(items)))
+	try:
+		return pool.map(function, items)
+	finally:
+		pool.close()
+
+def memoize(size=128):
+	"""Decorator: remember results of `size` most recent distinct calls."""
+	def decorator(function):
+		cache = LRU(size)
+		@functools.wraps(function)
+		def result(*args):
+			return cache.get(args, lambda: function(*args))
+		result.cache = cache
+		return result
+	return decorator
+
 def roundint(value):
 	return int(value + 0.5)
 
@@ -51,6 +74,44 @@ class Struct(object):
 	def __init__(self, **kwargs):
 		vars(self).update(kwargs)
 
+class LRU(object):
+	"""Mapping that forgets least recently used items beyond `size`.
+
+	Each item takes `weight(value)` of the size, 1 by default. Items
+	heavier than the whole size are not stored.
+	"""
+	def __init__(self, size, weight=None):
+		self.size = size
+		self.weight = weight or (lambda value: 1)
+		self.items = OrderedDict()
+		self.used = 0
+		self.hits = self.misses = 0
+	def __contains__(self, key):
+		return key in self.items
+	def __getitem__(self, key):
+		value = self.items.pop(key)
+		self.items[key] = value
+		return value
+	def __setitem__(self, key, value):
+		if key in self.items:
+			self.used -= self.weight(self.items.pop(key))
+		weight = self.weight(value)
+		if weight > self.size:
+			return
+		self.items[key] = value
+		self.used += weight
+		while self.used > self.size:
+			_, old = self.items.popitem(last=False)
+			self.used -= self.weight(old)
+	def get(self, key, function):
+		"""Return value for `key`; if missing, store `function()` first."""
+		if key in self.items:
+			self.hits += 1
+			return self[key]
+		self.misses += 1
+		value = self[key] = function()
+		return value
+
 class Re(object):
 	had_match = False
 	def __init__(self, text):
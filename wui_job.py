@@ -320,6 +320,8 @@ class Job(object):
 	def _run_processor(self):
 		"""Run the required function from processor to run the jub."""
 		options = Struct()
+		# jobs saved by older versions lack options added since
+		vars(options).update(processor.option_parser().defaults)
 		vars(options).update(self.options)
 		processor.parse_tuple_options(options)
 		processor.split_color_options(options)